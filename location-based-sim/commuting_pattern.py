@@ -1,8 +1,10 @@
+import heapq
+import math
 import random
-from typing import Callable, List, Optional, Tuple, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 from sites import PublicTransport, Site
-from timing import datetime, timedelta
+from timing import MINUTES_IN_DAY, MINUTES_IN_WEEK, clock
 
 
 class CommutingPattern:
@@ -47,9 +49,66 @@ class CommutingPattern:
         # following number (and limit by 1.0).
         self.probability_per_minute: float = None
 
-    def apply(self, current_site: Site, time: datetime, time_in_site: float,
+    def weekly_windows(self) -> List[Tuple[int, int]]:
+        """
+        the day and time of day conditions, compiled to a sorted list of
+        (start, end) time intervals in the week, in minutes since Monday
+        00:00 (the end is not included).
+        """
+        days = range(7) if self.day_condition is None else sorted(set(self.day_condition))
+        if self.minutes_condition is None:
+            start, end = 0, MINUTES_IN_DAY
+        else:
+            # the condition is checked on the whole minutes of the time of day
+            start = max(0, math.ceil(self.minutes_condition[0]))
+            end = min(MINUTES_IN_DAY, math.floor(self.minutes_condition[1]) + 1)
+        if start >= end:
+            return []
+        return [(day * MINUTES_IN_DAY + start, day * MINUTES_IN_DAY + end) for day in days]
+
+    def next_eligible_time(self, time: int, site_entry_time: int,
+                           time_step: int,
+                           windows: Optional[List[Tuple[int, int]]] = None
+                           ) -> Optional[int]:
+        """
+        find the earliest time step (a time of the form
+        `time + k * time_step`, for k = 0, 1, ...) in which the day, time of
+        day and time in site conditions are satisfied, where the time in the
+        current site is counted from `site_entry_time`. These are the
+        conditions that don't depend on the site or on randomness, so the
+        pattern can't be executed before this time.
+        If there is no such time, return `None`.
+        `windows` are the `weekly_windows` (they are calculated if not given).
+        """
+        if windows is None:
+            windows = self.weekly_windows()
+        if len(windows) == 0:
+            return None
+
+        earliest = time
+        if self.time_in_site_condition is not None:
+            earliest = max(earliest, site_entry_time + self.time_in_site_condition)
+
+        # the windows repeat every week, so there is no need to look further
+        last = earliest + MINUTES_IN_WEEK + time_step
+        while earliest <= last:
+            # round up to a time step
+            candidate = time + time_step * math.ceil((earliest - time) / time_step)
+            minute = clock.minute_of_week(candidate)
+            # the first window (in this week or the next one) that didn't end
+            for start, end in windows:
+                if minute < end:
+                    break
+            else:
+                start = windows[0][0] + MINUTES_IN_WEEK
+            if minute >= start:
+                return candidate
+            earliest = candidate + start - minute
+        return None
+
+    def apply(self, current_site: Site, time: int, time_in_site: float,
               time_step: float) -> Optional[
-        Tuple[Site, datetime]]:
+        Tuple[Site, int]]:
         """
         given the current site and time, and the total time of presence in the
         current site (in minutes), and the size of the time step (minutes),
@@ -66,13 +125,12 @@ class CommutingPattern:
 
         # check condition for day of weak
         if (self.day_condition is not None) and (
-                time.weekday() not in self.day_condition):
+                clock.weekday(time) not in self.day_condition):
             return None
 
         # check condition for time of day
         if (self.minutes_condition is not None) and (
-                not (self.minutes_condition[0] <= (
-                        60 * time.hour + time.minute) <=
+                not (self.minutes_condition[0] <= clock.minute_of_day(time) <=
                      self.minutes_condition[1])):
             return None
 
@@ -115,7 +173,107 @@ class CommutingPattern:
         else:
             travel_time = self.travel_time
 
-        # calculate arrival time at destination
-        final_time = time + timedelta(minutes=travel_time)
+        # calculate arrival time at destination (rounded up to a whole minute,
+        # as the simulation time is in whole minutes)
+        final_time = math.ceil(time + travel_time)
 
         return final_site, final_time
+
+
+class CommutingSchedule:
+    """
+    An index of the times in which people may move by their commuting
+    patterns, so that in each time step only these people are evaluated.
+    For each `Person`, the commuting patterns are indexed by their initial
+    site, and the day and time of day conditions are compiled to windows in
+    the week. From these, the next time in which one of the patterns of the
+    current site may be executed (the "next eligible time") is calculated
+    whenever the `Person` is evaluated, and kept in a min-heap.
+    """
+    def __init__(self, people: List['Person'], time_step: int):
+        """
+        `people` is the collection of all `Person`s (indexed by their ids).
+        `time_step' is the size of the time step, in minutes.
+        """
+        self.people = people
+        self.time_step = time_step
+
+        # for each `Person`: initial site -> the commuting patterns that may be
+        # executed in this site (the `None` key is for patterns without an
+        # initial site condition)
+        self.patterns_by_site: List[Dict[Optional[Site], List[CommutingPattern]]] = \
+            [self.compile(person) for person in people]
+
+        # the `weekly_windows` of each commuting pattern
+        self.windows: Dict[CommutingPattern, List[Tuple[int, int]]] = {
+            pattern: pattern.weekly_windows()
+            for person in people for pattern in person.commuting_patterns}
+
+        # the next eligible time of each `Person` (`None` if the `Person` is
+        # not waiting in the heap)
+        self.next_eligible_time: List[Optional[int]] = [None] * len(people)
+
+        # a min-heap of (next eligible time, person id). entries whose time is
+        # not the current next eligible time of the person are ignored.
+        self._heap: List[Tuple[int, int]] = []
+
+        self._is_started = False
+
+    @staticmethod
+    def compile(person: 'Person') -> Dict[Optional[Site], List[CommutingPattern]]:
+        """
+        index the commuting patterns of a `Person` by their initial sites
+        """
+        patterns_by_site = {}
+        for pattern in person.commuting_patterns:
+            sites = [None] if pattern.initial_site_condition is None \
+                else pattern.initial_site_condition
+            for site in sites:
+                patterns_by_site.setdefault(site, []).append(pattern)
+        return patterns_by_site
+
+    def start(self, time: int):
+        """
+        calculate the next eligible times of all people, at the first time
+        step. the initial `time_in_current_site` of each `Person` is
+        converted to a `site_entry_time`.
+        """
+        for person in self.people:
+            if person.site_entry_time is None:
+                person.site_entry_time = time - person.time_in_current_site
+            self.schedule(person, time)
+        self._is_started = True
+
+    def schedule(self, person: 'Person', time: int):
+        """
+        calculate the next eligible time of a `Person`, starting from the
+        given time step, and add it to the heap.
+        """
+        self.next_eligible_time[person.id] = None
+        if person.is_in_dummy_site:
+            return
+        patterns_by_site = self.patterns_by_site[person.id]
+        patterns = patterns_by_site.get(person.site, []) + patterns_by_site.get(None, [])
+        eligible_times = [pattern.next_eligible_time(time, person.site_entry_time,
+                                                     self.time_step, self.windows[pattern])
+                          for pattern in patterns]
+        eligible_times = [t for t in eligible_times if t is not None]
+        if len(eligible_times) > 0:
+            next_time = min(eligible_times)
+            self.next_eligible_time[person.id] = next_time
+            heapq.heappush(self._heap, (next_time, person.id))
+
+    def pop_eligible(self, time: int) -> List['Person']:
+        """
+        remove from the heap all the people whose next eligible time has
+        arrived, and return them.
+        """
+        if not self._is_started:
+            self.start(time)
+        eligible = []
+        while self._heap and self._heap[0][0] <= time:
+            eligible_time, person_id = heapq.heappop(self._heap)
+            if self.next_eligible_time[person_id] == eligible_time:
+                self.next_eligible_time[person_id] = None
+                eligible.append(self.people[person_id])
+        return eligible
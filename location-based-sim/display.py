@@ -6,7 +6,7 @@ from matplotlib.colors import LinearSegmentedColormap
 
 from initialize import AllSites
 from person import Person
-from timing import datetime
+from timing import clock
 
 
 class DisplayManager:
@@ -79,8 +79,8 @@ class DisplayManager:
             }
         )
 
-    def update(self, time: datetime):
-        self.time_txt.set_text(str(time))
+    def update(self, time: int):
+        self.time_txt.set_text(str(clock.to_datetime(time)))
 
         cmap = LinearSegmentedColormap.from_list('my_cmap',['blue','red'])
 
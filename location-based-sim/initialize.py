@@ -7,7 +7,7 @@ from typing import List
 from commuting_pattern import CommutingPattern
 from person import Household, Person, PersonOccupation, Sex
 from sites import BoundedArea, FixedSite, PublicTransport, Site, \
-    TransportStation, dummy_site
+    TransportStation, active_sites, dummy_site
 
 
 class AllSites:
@@ -37,6 +37,9 @@ class AllSites:
         # the singleton dummy site
         self.dummy_site = dummy_site
 
+        # the index of the sites in which people may meet or get infected
+        self.active_sites = active_sites
+
         self.households : List[Household] = []
 
     @property
@@ -191,6 +194,10 @@ def create_sites():
 
         all_sites.public_transports.append(public_transport)
 
+    # give every site a unique id
+    for site_id, site in enumerate(all_sites.sites):
+        site.id = site_id
+
     return all_sites
 
 
@@ -223,6 +230,7 @@ def create_people(sites: AllSites):
         # create each of the people who live in the house
         for i in range(number_of_people_in_household):
             person = Person()
+            person.id = len(people)
             household.people.append(person)
 
             if (i == 0):
@@ -268,7 +276,7 @@ def create_people(sites: AllSites):
             person.immunity_degree = 0.0
             person.abides_by_rules_degree = 0.0
             person.site = household.home
-            person.site.people.append(person)
+            person.site.add_person(person)
             person.time_in_current_site = 300
             person.current_commute = None
             person.current_commute_start_time = None
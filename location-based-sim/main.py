@@ -20,10 +20,12 @@ for each time step:
     for each `Site`:
         update the infection status for all `Person`s in the `Site`
 """
+from commuting_pattern import CommutingSchedule
 from initialize import create_people, create_sites
 from update import move_people, update_people_status
 from metrics import MetricManager
 from display import DisplayManager
+from meetings import ContactLog
 from timing import time_iter
 
 sites = create_sites()
@@ -38,17 +40,26 @@ display = DisplayManager(people, sites)
 # time step, in minutes
 time_step = 5
 
+schedule = CommutingSchedule(people, time_step)
+
 display_interval = 2
 metric_interval = 72
 
+# if not `None`, all the meetings are written to this file
+contact_log_path = None
+contact_log = None if contact_log_path is None else ContactLog(contact_log_path)
 
-for step, time in enumerate(time_iter(time_step)):
-    if step % metric_interval == 0:
-        metrics.show(time)
-    if step % display_interval == 0:
-        display.update(time)
-    # display.update(people, sites, step)
-    # policy.update(people, sites, metrics)
-    # move_public_transports(sites.public_transports, policy, time, time_step)
-    move_people(people, policy, time, time_step)
-    update_people_status(sites.sites, policy, time_step, time)
+try:
+    for step, time in enumerate(time_iter(time_step)):
+        if step % metric_interval == 0:
+            metrics.show(time)
+        if step % display_interval == 0:
+            display.update(time)
+        # display.update(people, sites, step)
+        # policy.update(people, sites, metrics)
+        # move_public_transports(sites.public_transports, policy, time, time_step)
+        move_people(schedule, policy, time, time_step)
+        update_people_status(sites.active_sites, policy, time_step, time, contact_log)
+finally:
+    if contact_log is not None:
+        contact_log.close()
@@ -1,10 +1,19 @@
+from typing import List, Optional
+
+import numpy as np
+
+# the record of a single contact in the contact log file. `time` is the
+# simulation time, in minutes.
+CONTACT_DTYPE = np.dtype([('time', np.int32), ('site', np.int32),
+                          ('person1', np.int32), ('person2', np.int32)])
+
 
 class Meeting:
     """
     Represents a single Meeting between two or more people
     """
     def __init__(self, person1, person2, site, time):
-        # date and time of the meeting
+        # the time of the meeting (the simulation time, in minutes)
         self._time = time
         # list of the people involved in the meeting
         self._people_involved = [person1, person2]
@@ -24,12 +33,13 @@ class Meeting:
         )
         return string
 
-    def update_log(self):
+    def update_log(self, contact_log: 'ContactLog'):
         """
-        writes down the meeting object in a log.txt file
-        work in progress.
+        writes down the meeting in a `ContactLog`.
         """
-        pass
+        contact_log.append(self._time, np.array([self._location.id]),
+                           np.array([self._people_involved[0].id]),
+                           np.array([self._people_involved[1].id]))
 
     def is_meeting_infected(self):
         """
@@ -39,3 +49,111 @@ class Meeting:
         return self._people_involved[1].is_infected or self._people_involved[0].is_infected
 
 
+class ContactLog:
+    """
+    A columnar log of all the contacts (meetings) in the simulation, for
+    contact tracing research. The contacts are kept in preallocated int32
+    arrays (time, site id, and the ids of the two people), and when the arrays
+    are full they are appended as one chunk to a binary file of
+    `CONTACT_DTYPE` records (which can be read with `read_contact_log`).
+    """
+    def __init__(self, path: str, chunk_size: int = 1000000, seed: Optional[int] = None):
+        """
+        :param path - the log file. new contacts are appended to it.
+        :param chunk_size - the number of contacts held in memory between writes
+        :param seed - the seed of `self.rng`
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+
+        # the random generator of the meetings that are drawn only for the log
+        # (in the sites without infected people). it's separate from the global
+        # one, so logging doesn't change the simulation.
+        self.rng = np.random.RandomState(seed)
+
+        # the buffered contacts (only the first `self.size` are used)
+        self.time = np.zeros(chunk_size, dtype=np.int32)
+        self.site = np.zeros(chunk_size, dtype=np.int32)
+        self.person1 = np.zeros(chunk_size, dtype=np.int32)
+        self.person2 = np.zeros(chunk_size, dtype=np.int32)
+        self.size = 0
+
+        # the number of contacts written to the file so far
+        self.number_written = 0
+
+        self._file = open(path, 'ab')
+
+    def append(self, time: int, site_ids: np.ndarray,
+               person1_ids: np.ndarray, person2_ids: np.ndarray):
+        """
+        add contacts that happened at the given time.
+        :param site_ids - the site id of every contact (or a single id for all)
+        :param person1_ids, person2_ids - the ids of the people of every contact
+        """
+        number_of_contacts = len(person1_ids)
+        site_ids = np.broadcast_to(site_ids, (number_of_contacts,))
+        start = 0
+        while start < number_of_contacts:
+            if self.size == self.chunk_size:
+                self.flush()
+            end = min(number_of_contacts, start + self.chunk_size - self.size)
+            buffer_slice = slice(self.size, self.size + end - start)
+            self.time[buffer_slice] = time
+            self.site[buffer_slice] = site_ids[start:end]
+            self.person1[buffer_slice] = person1_ids[start:end]
+            self.person2[buffer_slice] = person2_ids[start:end]
+            self.size += end - start
+            start = end
+
+    def log_meetings(self, sites: List['Site'], time: int,
+                     site_indices: np.ndarray, initiators: np.ndarray,
+                     partners: np.ndarray):
+        """
+        add the meetings returned by `check_meetings(sites, time)`.
+        """
+        if len(site_indices) == 0:
+            return
+        # the ids of all the people in all the sites, one site after the other
+        ids = np.concatenate([site.people.ids for site in sites])
+        offsets = np.cumsum([0] + [len(site.people) for site in sites[:-1]])
+        site_offsets = offsets[site_indices]
+        site_ids = np.array([site.id for site in sites], dtype=np.int32)
+        self.append(time, site_ids[site_indices], ids[site_offsets + initiators],
+                    ids[site_offsets + partners])
+
+    def flush(self):
+        """
+        write the buffered contacts to the end of the file.
+        """
+        if self.size == 0:
+            return
+        records = np.empty(self.size, dtype=CONTACT_DTYPE)
+        records['time'] = self.time[:self.size]
+        records['site'] = self.site[:self.size]
+        records['person1'] = self.person1[:self.size]
+        records['person2'] = self.person2[:self.size]
+        records.tofile(self._file)
+        self._file.flush()
+        self.number_written += self.size
+        self.size = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_contact_log(path: str, mmap: bool = True) -> np.ndarray:
+    """
+    read a contact log file written by a `ContactLog`.
+    :param mmap - if True, the file is memory mapped instead of read
+    :return array of `CONTACT_DTYPE` records
+    """
+    if mmap:
+        return np.memmap(path, dtype=CONTACT_DTYPE, mode='r')
+    return np.fromfile(path, dtype=CONTACT_DTYPE)
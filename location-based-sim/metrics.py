@@ -2,7 +2,7 @@ from typing import List
 
 from person import Person
 from sites import Site
-from timing import datetime
+from timing import clock
 from initialize import AllSites
 
 
@@ -26,8 +26,8 @@ class MetricManager:
         tot = s + i + r
         return s / tot, i / tot, r / tot
 
-    def show(self, time:datetime):
+    def show(self, time: int):
         s,i,r = self.get_sir_proportions()
-        print(time)
+        print(clock.to_datetime(time))
         print('S: {:6.2f}%   I: {:6.2f}%   R: {:6.2f}%'.format(s*100,i*100,r*100))
         print('')
\ No newline at end of file
@@ -3,7 +3,6 @@ from typing import List, Optional, Union
 
 from commuting_pattern import CommutingPattern
 from sites import Site, FixedSite, dummy_site, DummySite
-from timing import datetime
 
 
 class Sex(Enum):
@@ -37,6 +36,9 @@ class Person:
     Represents a single person
     """
     def __init__(self):
+        # a unique id, given when the person is created
+        self.id: Optional[int] = None
+
         # age, in years
         self.age: float = None
         self.sex: Sex = None
@@ -68,9 +70,15 @@ class Person:
         # The `Person` is currently in this place.
         self.site: Union[Site, DummySite] = None
 
-        # times, in minutes, of being in the current place
+        # times, in minutes, of being in the current place. it is not
+        # incremented every time step, but derived from `site_entry_time` when
+        # needed (see `get_time_in_current_site`).
         self.time_in_current_site: float = None
 
+        # the time from which `time_in_current_site` is counted. a `Person`
+        # who moves in a time step arrives at the end of the time step.
+        self.site_entry_time: Optional[int] = None
+
         #
         self.current_commute: Optional[CommutingPattern] = None
         self.current_commute_start_time: Optional[float] = None
@@ -81,7 +89,7 @@ class Person:
         # if the `Person` is not in the dummy site, these should have the `None`
         # value.
         self.next_site: Optional[Site] = None
-        self.next_site_time: Optional[datetime] = None
+        self.next_site_time: Optional[int] = None
 
 
     @property
@@ -98,6 +106,14 @@ class Person:
     def is_in_dummy_site(self):
         return self.site == dummy_site
 
+    def get_time_in_current_site(self, time: int) -> float:
+        """
+        get the time, in minutes, of being in the current place, at the given
+        time.
+        """
+        self.time_in_current_site = time - self.site_entry_time
+        return self.time_in_current_site
+
     def change_site(self, new_site: Site):
         """
         invoke this function when moving from site to site
@@ -111,18 +127,27 @@ class Person:
                 self.next_site_time = None
 
             # remove `Person` from its current site.
-            self.site.people.remove(self)
+            self.site.remove_person(self)
 
             # change site of `Person`
             self.site = new_site
 
             # add `Person` to new site
-            new_site.people.append(self)
+            new_site.add_person(self)
 
             # reset counter of time in site.
             self.time_in_current_site = 0
 
-    def put_in_dummy_site(self, next_site:Site, next_site_time:datetime):
+    def set_infected(self, is_infected: bool):
+        """
+        invoke this function when the `Person` gets infected or heals, so the
+        number of infected people in the site is kept up to date
+        """
+        if self.is_infected != is_infected:
+            self.is_infected = is_infected
+            self.site.change_number_of_infected(1 if is_infected else -1)
+
+    def put_in_dummy_site(self, next_site:Site, next_site_time:int):
         """
         put the `Person` in the dummy site. The dummy site is a place for
         temporarily hiding the `Person` until it gets to its next destination,
@@ -133,6 +158,7 @@ class Person:
 
         self.next_site = next_site
         self.next_site_time = next_site_time
+        dummy_site.add_arrival(self)
     #
     # def is_infected(self):
     #     """
@@ -1,7 +1,6 @@
-from typing import List, Tuple, Optional
-from timing import datetime
-from meetings import Meeting
-import random
+import heapq
+from typing import Dict, Iterator, List, Set, Tuple, Optional
+import numpy as np
 
 class BoundedArea:
     """
@@ -15,6 +14,76 @@ class BoundedArea:
         self.sites: List['Site'] = None
 
 
+class PeopleSet:
+    """
+    The collection of `Person`s who are currently in a `Site`. Adding and
+    removing a `Person` take O(1), even in very crowded sites (such as the
+    `DummySite`): the people are kept in a list, together with the index of
+    each `Person` in the list, and a removed `Person` is replaced by the last
+    `Person` in the list (so removing changes the order of the people).
+    It can be iterated, indexed and used with `random.choice`, like a list.
+    """
+    def __init__(self):
+
+        # the people, in an arbitrary order
+        self._people: List['Person'] = []
+
+        # the index of each `Person` in `self._people`
+        self._index: Dict['Person', int] = {}
+
+        # the ids of the people, in the order of `self._people` (only the
+        # first `len(self)` entries are used). this lets meetings, given as
+        # indices, be translated to person ids without a loop.
+        self._ids: np.ndarray = np.zeros(8, dtype=np.int32)
+
+    def append(self, person: 'Person'):
+        """
+        add a `Person` (that is not already in the collection)
+        """
+        if person in self._index:
+            raise ValueError('{} is already in the site'.format(person))
+        index = len(self._people)
+        if index == len(self._ids):
+            self._ids = np.concatenate([self._ids, np.zeros_like(self._ids)])
+        self._ids[index] = -1 if person.id is None else person.id
+        self._index[person] = index
+        self._people.append(person)
+
+    def remove(self, person: 'Person'):
+        """
+        remove a `Person` from the collection
+        """
+        if person not in self._index:
+            raise ValueError('{} is not in the site'.format(person))
+        index = self._index.pop(person)
+        last_person = self._people.pop()
+        if last_person is not person:
+            # move the last `Person` into the slot of the removed one
+            self._people[index] = last_person
+            self._index[last_person] = index
+            self._ids[index] = self._ids[len(self._people)]
+
+    @property
+    def ids(self) -> np.ndarray:
+        """
+        the ids of the people, in the order of iteration (a view, which
+        changes when people are added or removed)
+        """
+        return self._ids[:len(self._people)]
+
+    def __contains__(self, person: 'Person') -> bool:
+        return person in self._index
+
+    def __len__(self) -> int:
+        return len(self._people)
+
+    def __getitem__(self, index):
+        return self._people[index]
+
+    def __iter__(self) -> Iterator['Person']:
+        return iter(self._people)
+
+
 class SiteBase:
     """
     base class for all `Site` classes. The only thing in common with all `Site`s
@@ -23,8 +92,48 @@ class SiteBase:
     """
     def __init__(self):
 
-        # list of people current in the site
-        self.people: List['Person'] = []
+        # a unique id, given when the site is created
+        self.id: Optional[int] = None
+
+        # collection of people current in the site
+        self.people: PeopleSet = PeopleSet()
+
+        # the number of infected people in `self.people`
+        self.number_of_infected: int = 0
+
+    def add_person(self, person: 'Person'):
+        """
+        add a `Person` to the site (use this instead of `self.people.append`,
+        so the counts of the site are kept up to date)
+        """
+        self.people.append(person)
+        if person.is_infected:
+            self.number_of_infected += 1
+        self.update_activity()
+
+    def remove_person(self, person: 'Person'):
+        """
+        remove a `Person` from the site (use this instead of
+        `self.people.remove`, so the counts of the site are kept up to date)
+        """
+        self.people.remove(person)
+        if person.is_infected:
+            self.number_of_infected -= 1
+        self.update_activity()
+
+    def change_number_of_infected(self, change: int):
+        """
+        invoke this function when people in the site get infected or heal
+        """
+        self.number_of_infected += change
+        self.update_activity()
+
+    def update_activity(self):
+        """
+        invoked whenever the people in the site or the number of infected
+        people change. nothing happens in a `SiteBase`, see `Site`.
+        """
+        pass
 
 
 class DummySite(SiteBase):
@@ -39,6 +148,31 @@ class DummySite(SiteBase):
     def __init__(self):
         SiteBase.__init__(self)
 
+        # a min-heap of the people in transit, as tuples of
+        # (next_site_time, person id, `Person`), so that in each time step only
+        # the people who arrive are taken out.
+        self.arrivals: List[Tuple[int, int, 'Person']] = []
+
+    def add_arrival(self, person: 'Person'):
+        """
+        schedule the arrival of a `Person` (in the site) to its next site, at
+        its `next_site_time`.
+        """
+        heapq.heappush(self.arrivals, (person.next_site_time, person.id, person))
+
+    def pop_arrivals(self, time: int) -> List['Person']:
+        """
+        take out of the heap all the people whose `next_site_time` has
+        arrived, and return them.
+        """
+        arrivals = []
+        while self.arrivals and self.arrivals[0][0] <= time:
+            next_site_time, _, person = heapq.heappop(self.arrivals)
+            # ignore people who already left (or are waiting for another time)
+            if person.site is self and person.next_site_time == next_site_time:
+                arrivals.append(person)
+        return arrivals
+
 # this is the only instance of the `DummySite`
 dummy_site = DummySite()
 
@@ -64,6 +198,12 @@ class Site(SiteBase):
         # and the dispersion factor of the site
         self.meeting_probability: float = None
 
+    def update_activity(self):
+        """
+        update the `active_sites` index of the site
+        """
+        active_sites.update(self)
+
     def update_meeting_probability(self, time_step):
         """
         calculates the meeting probabilty in a 'Site' in a certain moment.
@@ -77,22 +217,92 @@ class Site(SiteBase):
             m_p = (len(self.people)*time_step/self.area)*self.dispersion_factor
             self.meeting_probability = m_p if m_p < 1 else 1
 
-    def check_meeting(self, time: datetime):
+    def check_meeting(self, time: int) -> Tuple[np.ndarray, np.ndarray]:
         """
         checks for meetings randomly using the meeting probability.
-        if the randomized number is in the range of the meeting probability a 'Meeting' object is created.
-        :return list of meetings that occured in the 'Site'.
-                if no meetings were created returns an empty list.
+        every `Person` in the site initiates a meeting with probability
+        `meeting_probability`, with another `Person` in the site chosen
+        uniformly at random (see `check_meetings` for many sites at once).
+        :return tuple of two arrays, (initiators, partners), with the indices
+                in `self.people` of the two people of each meeting that occured
+                in the 'Site'. if no meetings were created the arrays are empty.
+        """
+        _, initiators, partners = check_meetings([self], time)
+        return initiators, partners
+
+
+class ActiveSites:
+    """
+    An index of the `Site`s in which people may meet - the sites with at least
+    two people (the "crowded" sites), and of the sites in which people may get
+    infected - the crowded sites with at least one infected `Person` (the
+    "active" sites). The sites update the index whenever their people or their
+    number of infected people change, so the update of the people's status
+    can skip all the other sites. This class should be a singleton (i.e only
+    one instance)
+    """
+    def __init__(self):
+        self.crowded: Set[Site] = set()
+        self.active: Set[Site] = set()
+
+    def update(self, site: Site):
+        """
+        update the index with the current counts of a `Site`
+        """
+        if len(site.people) >= 2:
+            self.crowded.add(site)
+            if site.number_of_infected > 0:
+                self.active.add(site)
+            else:
+                self.active.discard(site)
+        else:
+            self.crowded.discard(site)
+            self.active.discard(site)
+
+    def get_crowded(self) -> List[Site]:
+        """
+        get the crowded sites, ordered by id
+        """
+        return sorted(self.crowded, key=lambda site: site.id)
+
+    def get_active(self) -> List[Site]:
         """
-        meetings = []
-        if self.meeting_probability > 0:
-            for i in range(len(self.people)):
-                if random.uniform(0, 1) <= self.meeting_probability:
-                    person1 = self.people[i]
-                    person2 = random.choice([person for person in self.people if person != person1])
-                    meeting = Meeting(person1=person1, person2=person2, site=self, time=time)
-                    meetings.append(meeting)
-        return meetings
+        get the active sites, ordered by id
+        """
+        return sorted(self.active, key=lambda site: site.id)
+
+# this is the only instance of `ActiveSites`
+active_sites = ActiveSites()
+
+
+def check_meetings(sites: List[Site], time: int,
+                   rng: Optional[np.random.RandomState] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    checks for meetings in all the given sites at once, with the same
+    distribution as `Site.check_meeting` in each site. the random numbers of
+    all the people in all the sites are drawn together, so the cost of a step
+    doesn't grow with the number of (mostly small) sites.
+    :param rng - the random generator. by default, the global numpy one.
+    :return tuple of three arrays, (site_indices, initiators, partners). for
+            each meeting, the index of its site in `sites`, and the indices in
+            `site.people` of its two people. the meetings are ordered by site.
+    """
+    number_of_people = np.array([len(site.people) for site in sites], dtype=np.int64)
+    meeting_probability = np.array([site.meeting_probability if len(site.people) >= 2 else 0 for site in sites],
+                                   dtype=float)
+
+    # every `Person` initiates a meeting with the meeting probability of its site
+    if rng is None:
+        rng = np.random
+    is_initiator = rng.random(number_of_people.sum()) <= np.repeat(meeting_probability, number_of_people)
+    initiators = np.flatnonzero(is_initiator)
+    site_indices = np.repeat(np.arange(len(sites)), number_of_people)[initiators]
+    initiators -= (np.cumsum(number_of_people) - number_of_people)[site_indices]
+
+    # shifting by 1 to `n - 1` places gives every other `Person` in the site the same chance
+    n = number_of_people[site_indices]
+    partners = (initiators + 1 + rng.randint(0, n - 1)) % n
+    return site_indices, initiators, partners
 
 
 class FixedSite(Site):
@@ -161,4 +371,4 @@ class PublicTransport(Site):
         self.next_station_index: Optional[int] = None
 
         # time of stop in next station in `path`
-        self.next_station_time: Optional[datetime] = None
\ No newline at end of file
+        self.next_station_time: Optional[int] = None
\ No newline at end of file
@@ -1,7 +1,9 @@
 """
-functions usefull for dealing with time
+functions usefull for dealing with time.
+the simulation time is an integer number of minutes since the initial time of
+the simulation. `datetime`s are created from it (by the `clock`) only for
+showing the time.
 """
-from copy import copy
 from datetime import datetime, timedelta
 from typing import Optional
 
@@ -12,17 +14,77 @@ from pytz import timezone
 datetime = datetime
 timedelta = timedelta
 
-def time_iter(time_step_minutes: float, initial_time: Optional[datetime] = None):
+MINUTES_IN_DAY = 24 * 60
+MINUTES_IN_WEEK = 7 * MINUTES_IN_DAY
+
+# lookup tables from the minute in the week (since Monday 00:00) to the day of
+# the week (Monday = 0, Sunday = 6) and to the minute in the day
+WEEKDAY_OF_MINUTE = [minute // MINUTES_IN_DAY for minute in range(MINUTES_IN_WEEK)]
+MINUTE_OF_DAY = [minute % MINUTES_IN_DAY for minute in range(MINUTES_IN_WEEK)]
+
+
+class SimulationClock:
+    """
+    converts the simulation time (an integer number of minutes since
+    `initial_time`) to the day of the week, the time of day, or a `datetime`.
+    """
+    def __init__(self, initial_time: Optional[datetime] = None):
+        self.initial_time: datetime = None
+
+        # the minute in the week of the simulation time 0
+        self.week_offset: int = None
+
+        self.set_initial_time(initial_time)
+
+    def set_initial_time(self, initial_time: Optional[datetime] = None):
+        """
+        set the `datetime` of the simulation time 0 (should be a whole minute)
+        """
+        if initial_time is None:
+            # if we don't have an initial time, use this default.
+            initial_time = datetime(2020, 3, 1, 0, 0) # tzinfo=timezone('Israel'))
+        self.initial_time = initial_time
+        self.week_offset = initial_time.weekday() * MINUTES_IN_DAY + \
+                           60 * initial_time.hour + initial_time.minute
+
+    def minute_of_week(self, time: int) -> int:
+        """
+        the minute in the week (since Monday 00:00) of a simulation time
+        """
+        return (time + self.week_offset) % MINUTES_IN_WEEK
+
+    def weekday(self, time: int) -> int:
+        """
+        the day of the week of a simulation time (Monday = 0, Sunday = 6)
+        """
+        return WEEKDAY_OF_MINUTE[(time + self.week_offset) % MINUTES_IN_WEEK]
+
+    def minute_of_day(self, time: int) -> int:
+        """
+        the minute in the day (60 * hour + minute) of a simulation time
+        """
+        return MINUTE_OF_DAY[(time + self.week_offset) % MINUTES_IN_WEEK]
+
+    def to_datetime(self, time: float) -> datetime:
+        """
+        the `datetime` of a simulation time
+        """
+        return self.initial_time + timedelta(minutes=time)
+
+
+# this is the only instance of the `SimulationClock`
+clock = SimulationClock()
+
+
+def time_iter(time_step_minutes: int, initial_time: Optional[datetime] = None):
     """
-    a generator for iterating from an initial time to infinity, with a fixed
-    time step.
+    a generator for iterating over the simulation time (in minutes), from 0 to
+    infinity, with a fixed time step.
+    if `initial_time` is given, it is set as the initial time of the `clock`.
     """
-    time_step = timedelta(minutes=time_step_minutes)
-    if initial_time is None:
-        # if we don't have an initial time, use this default.
-        current_time = datetime(2020, 3, 1, 0, 0) # tzinfo=timezone('Israel'))
-    else:
-        current_time = copy(initial_time)
+    if initial_time is not None:
+        clock.set_initial_time(initial_time)
+    current_time = 0
     while True:
         yield current_time
-        current_time = current_time + time_step
+        current_time += time_step_minutes
@@ -2,26 +2,35 @@
 functions for updating the state of the world
 """
 import random
-from typing import List
+from typing import Optional, Tuple
 
+import numpy as np
+
+from commuting_pattern import CommutingSchedule
+from meetings import ContactLog
 from person import Person
-from sites import Site
-from timing import datetime
-from functools import reduce
+from sites import ActiveSites, Site, check_meetings, dummy_site
 
 
-def move_people(people: List[Person], policy, time: datetime, time_step: float):
+def move_people(schedule: CommutingSchedule, policy, time: int, time_step: float):
     """
-    move all people from site to site.
-    `people` is the collection of all `Person`s.
+    move people from site to site.
+    `schedule` is the `CommutingSchedule` of all `Person`s. only the people
+    whose commuting patterns may be executed in this time step, and the
+    people who arrive from the dummy site, are evaluated.
     `time` is the current time.
     `time_step' is the size of the time step, in minutes.
     """
+    people = schedule.pop_eligible(time) + dummy_site.pop_arrivals(time)
+    # people are evaluated in a fixed order (by id), as moving changes the
+    # order of the people in the sites.
+    people.sort(key=lambda person: person.id)
     for person in people:
         move_person(person, policy, time, time_step)
+        schedule.schedule(person, time + time_step)
 
 
-def move_person(person: Person, policy, time: datetime, time_step: float):
+def move_person(person: Person, policy, time: int, time_step: float):
     """
     move person to next location, taking into account also the policy.
     `time` is the current time.
@@ -34,10 +43,10 @@ def move_person(person: Person, policy, time: datetime, time_step: float):
         if time >= person.next_site_time:
             new_site = person.next_site
             person.change_site(new_site)
-        else:
-            person.time_in_current_site += time_step
+            person.site_entry_time = time + time_step
         return
     else:
+        person.get_time_in_current_site(time)
 
         # `out` will have the result of the first commuting pattern to be
         # executed. if no commuting pattern is executed, it will remain `None`.
@@ -50,37 +59,57 @@ def move_person(person: Person, policy, time: datetime, time_step: float):
                 break
         if out is None:
             # no commuting pattern was executed - don't move person.
-            person.time_in_current_site += time_step
             return
         else:
             # a commuting pattern was executed.
             if new_site == person.site:
                 # if the new site equal the current site, don't do anything.
-                person.time_in_current_site += time_step
                 return
             elif next_site_time > time:
                 # if the destination time in the new site is in the future - go
                 # temporarily to the dummy site.
                 person.put_in_dummy_site(new_site, next_site_time)
+                person.site_entry_time = time + time_step
             else:
                 # otherwise, go to the destination
                 person.change_site(new_site)
+                person.site_entry_time = time + time_step
 
 
-def update_people_status(sites: List[Site], policy, time_step: float, time: datetime):
+def update_people_status(active_sites: ActiveSites, policy, time_step: float, time: int,
+                         contact_log: Optional[ContactLog] = None):
     """
-    update the status of all people, by looping over all sites and updating
-    for the people in each site.
+    update the status of all people, by looping over the sites in which
+    people may get infected (the active sites), and updating for the people
+    in each site.
+    `active_sites` is the `ActiveSites` index of all the sites.
     `time_step' is the size of the time step, in minutes.
     :param time - current time
+    :param contact_log - if given, all the meetings are written to it (so the
+                         meetings are drawn in all the crowded sites, not only
+                         in the active ones)
     """
+    sites = active_sites.get_active()
     for site in sites:
-        ###
         site.update_meeting_probability(time_step)
-        meetings = site.check_meeting(time)
-        ###
+
+    # the meetings of all sites are drawn together, and they are ordered by site
+    site_indices, initiators, partners = check_meetings(sites, time)
+    if contact_log is not None:
+        contact_log.log_meetings(sites, time, site_indices, initiators, partners)
+        # the meetings of the crowded sites without infected people are drawn
+        # with the log's own generator, so logging doesn't change the random
+        # numbers of the simulation
+        quiet_sites = [site for site in active_sites.get_crowded() if site not in active_sites.active]
+        for site in quiet_sites:
+            site.update_meeting_probability(time_step)
+        contact_log.log_meetings(quiet_sites, time, *check_meetings(quiet_sites, time, contact_log.rng))
+    meeting_sites, starts = np.unique(site_indices, return_index=True)
+    ends = np.append(starts[1:], len(site_indices))
+    for site_index, start, end in zip(meeting_sites.tolist(), starts.tolist(), ends.tolist()):
         # update_people_status_for_site(site, policy, time_step, meetings)
-        update_people_status_based_on_meetings(site, policy, time_step, meetings)
+        update_people_status_based_on_meetings(sites[site_index], policy, time_step,
+                                               (initiators[start:end], partners[start:end]))
 
 def update_people_status_for_site(site: Site, policy, time_step: float, meetings: list):
     """
@@ -139,23 +168,28 @@ def update_people_status_for_site(site: Site, policy, time_step: float, meetings
                 else:
                     person.time_infected_minutes += time_step
 
-def update_people_status_based_on_meetings(site: Site, policy, time_step: float, meetings: list):
+def update_people_status_based_on_meetings(site: Site, policy, time_step: float,
+                                           meetings: Tuple[np.ndarray, np.ndarray]):
     """
     update the status of all people in given site.
     `time_step' is the size of the time step, in minutes.
+    `meetings` are the (initiators, partners) index arrays returned by
+    `Site.check_meeting`.
     """
+    people = site.people
 
     # reduces only for meetings that contained an infected person
-    meetings = [meeting for meeting in meetings if meeting.is_meeting_infected()]
+    meetings = [(people[i], people[j]) for i, j in zip(meetings[0].tolist(), meetings[1].tolist())
+                if people[i].is_infected or people[j].is_infected]
 
     if len(meetings) > 0:
         site_infecting_score = calculate_site_infection_score(site, time_step)
-        all_people_envolved = reduce(lambda a, b: a + b, [meeting._people_involved for meeting in meetings])
-        for person in all_people_envolved:
-            if person.is_infected:
-                try_to_heal(person, time_step)
-            else:
-                try_to_infect(person, site_infecting_score)
+        for meeting in meetings:
+            for person in meeting:
+                if person.is_infected:
+                    try_to_heal(person, time_step)
+                else:
+                    try_to_infect(person, site_infecting_score)
 
 def calculate_site_infection_score(site: Site, time_step):
     """
@@ -170,8 +204,7 @@ def calculate_site_infection_score(site: Site, time_step):
         return
 
     # calculate several variables
-    number_of_ill_people = len([person for person in site.people if person.is_infected])
-    ratio_of_ill_people = number_of_ill_people / number_of_people
+    ratio_of_ill_people = site.number_of_infected / number_of_people
     density = number_of_people / site.area
     ratio_of_capacity = number_of_people / site.nominal_capacity
 
@@ -197,7 +230,7 @@ def try_to_heal(person, time_step):
         person.illness_degree = 0.0
         person.immunity_degree = 1.0
         person.time_infected_minutes = None
-        person.is_infected = False
+        person.set_infected(False)
     #if not healed
     else:
         person.time_infected_minutes += time_step
@@ -217,4 +250,4 @@ def try_to_infect(person, site_infecting_score):
     if random.random() < person_infecting_score:
         person.illness_degree = 1.0
         person.time_infected_minutes = 0.0
-        person.is_infected = True
+        person.set_infected(True)
@@ -0,0 +1,234 @@
+"""
+Scaling benchmarks of the SIR simulation: fixed-seed scenarios over population size, infected fraction, density
+(people per unit area), infection_radius and iter_per_day. The time per step, and the time and optionally the peak
+memory of every phase, are written to a JSON file, and can be compared to a baseline file:
+    python sir_benchmark.py --output results.json
+    python sir_benchmark.py --sizes 1000 10000 --baseline results.json --threshold 0.2
+The exit code is 1 if some scenario is slower than its baseline by more than the threshold, and 2 if the baseline
+was run with different settings (see COMPARED_SETTINGS).
+The cold-start import of the simulation core can be checked against a time budget instead (for headless workers):
+    python sir_benchmark.py --import-budget 0.5
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from sir_profiling import PhaseProfiler
+from sir_simulation_classes import SIR
+
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000, 10000000)
+# the size of the scenarios that vary a single parameter around the base scenario (at most the largest size)
+VARIATION_SIZE = 100000
+BASE_SCENARIO = {
+    'infected_fraction': 0.01,
+    'density': 1e-3,  # people per unit area
+    'infection_radius': 10,
+    'iter_per_day': 4,
+}
+# modules that the headless core shouldn't import (they are imported only when plotting, building DataFrames, etc.)
+HEAVY_MODULES = ('matplotlib', 'pandas', 'scipy', 'tqdm')
+VARIATIONS = {
+    'infected_fraction': [0.001, 0.1],
+    'density': [1e-4, 1e-2],
+    'infection_radius': [3, 30],
+    'iter_per_day': [1, 24],
+}
+# the settings (in the meta of the results) that must be the same for results to be comparable
+COMPARED_SETTINGS = ('n_steps', 'track_memory', 'neighbor_search')
+
+
+def scenario_params(n_agents, infected_fraction, density, infection_radius, iter_per_day, n_steps):
+    """
+    :return: SIR params of a scenario, long enough for n_steps iterations
+    """
+    n_infected = max(int(n_agents * infected_fraction), 1)
+    return {
+        'n_days': (n_steps + 2) / iter_per_day,
+        'iter_per_day': iter_per_day,
+        'init_status': {'S': n_agents - n_infected, 'I': n_infected, 'R': 0},
+        'I_init_pos': None,
+        'map_size': float(np.sqrt(n_agents / density)),
+        'step_size_iter': 10,
+        'random_state': 42,
+        'infection_radius': infection_radius,
+        'infection_duration': 20,
+        'symptoms_prob': 0.2,
+        'days_to_symptoms': 5,
+        'non_infective_symptoms_prob': 0.01,
+        'tests_per_day': n_agents // 100,
+    }
+
+
+def scenarios(sizes=DEFAULT_SIZES):
+    """
+    The base scenario for every size, and the variations of every parameter at VARIATION_SIZE
+    :return: list of (name, scenario dict)
+    """
+    result = [(f'base_n{n}', dict(BASE_SCENARIO, n_agents=n)) for n in sizes]
+    variation_size = min(VARIATION_SIZE, max(sizes))
+    for param, values in VARIATIONS.items():
+        for value in values:
+            result.append((f'{param}_{value}_n{variation_size}',
+                           dict(BASE_SCENARIO, n_agents=variation_size, **{param: value})))
+    return result
+
+
+def run_scenario(scenario, n_steps=10, track_memory=False, **extra_params):
+    """
+    Initiate a simulation and time n_steps iterations (after a warm-up iteration)
+    :param scenario: dict with n_agents and the keys of BASE_SCENARIO
+    :param track_memory: also record the peak memory of every phase. It's measured in a second run of the same
+                         steps, so the tracing overhead isn't included in the times
+    :param extra_params: more SIR params (e.g. neighbor_search)
+    :return: dict of results
+    """
+    params = dict(scenario_params(n_steps=n_steps, **scenario), **extra_params)
+    start = time.perf_counter()
+    sir = SIR(params)
+    init_seconds = time.perf_counter() - start
+    sir.sir_iter()
+    sir.profiler = PhaseProfiler()
+    step_seconds = []
+    for _ in range(n_steps):
+        start = time.perf_counter()
+        sir.sir_iter()
+        step_seconds.append(time.perf_counter() - start)
+    phases = sir.profiler.summary()
+    if track_memory:
+        was_tracing = tracemalloc.is_tracing()
+        sir = SIR(params)
+        sir.sir_iter()
+        sir.profiler = PhaseProfiler(track_memory=True)
+        for _ in range(n_steps):
+            sir.sir_iter()
+        if not was_tracing:
+            # the profiler started tracing, which would slow down the timing of the next scenarios
+            tracemalloc.stop()
+        for name, stats in sir.profiler.summary().items():
+            phases[name]['peak_bytes'] = stats['peak_bytes']
+    return {
+        'scenario': scenario,
+        'init_seconds': init_seconds,
+        'step_seconds_mean': float(np.mean(step_seconds)),
+        'step_seconds_p95': float(np.percentile(step_seconds, 95)),
+        'population_bytes': int(sir.pop.nbytes),
+        'phases': {name: {key: value if isinstance(value, int) else float(value) for key, value in stats.items()}
+                   for name, stats in phases.items()},
+    }
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, n_steps=10, track_memory=False, verbose=True, **extra_params):
+    """
+    :return: dict with 'meta' (versions, platform) and 'results' (scenario name -> results of run_scenario)
+    """
+    results = {}
+    for name, scenario in scenarios(sizes):
+        results[name] = run_scenario(scenario, n_steps=n_steps, track_memory=track_memory, **extra_params)
+        if verbose:
+            print(f'{name:<40}{results[name]["step_seconds_mean"] * 1e3:>12.2f} ms/step')
+    meta = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'n_steps': n_steps,
+        'track_memory': track_memory,
+        'neighbor_search': extra_params.get('neighbor_search', 'kdtree'),
+        'params': extra_params,
+    }
+    return {'meta': meta, 'results': results}
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Compare the mean step time of every scenario that appears in both results
+    :param results: the output of run_benchmarks
+    :param baseline: the output of run_benchmarks in a previous run
+    :param threshold: the relative slowdown that counts as a regression
+    :return: dict from the name of every regressed scenario to its slowdown ratio
+    """
+    different = [key for key in COMPARED_SETTINGS if results['meta'].get(key) != baseline['meta'].get(key)]
+    if different:
+        raise ValueError('the results and the baseline were run with different settings: ' +
+                         ', '.join(f'{key}={results["meta"].get(key)!r} (baseline: {baseline["meta"].get(key)!r})'
+                                   for key in different))
+    regressions = {}
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        ratio = result['step_seconds_mean'] / baseline['results'][name]['step_seconds_mean']
+        if ratio > 1 + threshold:
+            regressions[name] = ratio
+    return regressions
+
+
+def measure_import(module='sir_simulation_classes', repeats=5):
+    """
+    Time the import of a module in fresh interpreters
+    :param module: the module to import
+    :param repeats: the number of interpreters (the best time is taken)
+    :return: (seconds, list of the HEAVY_MODULES that the import loaded)
+    """
+    code = (f'import sys, time; start = time.perf_counter(); import {module}; '
+            f'print(time.perf_counter() - start); print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))')
+    seconds = []
+    loaded = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.split('\n')
+        seconds.append(float(output[0]))
+        loaded = [name for name in output[1].split(',') if name]
+    return min(seconds), loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES))
+    parser.add_argument('--steps', type=int, default=10, help='the number of timed iterations of every scenario')
+    parser.add_argument('--output', help='a JSON file for the results')
+    parser.add_argument('--baseline', help='a JSON results file to compare to')
+    parser.add_argument('--threshold', type=float, default=0.2, help='the relative slowdown that fails the run')
+    parser.add_argument('--memory', action='store_true',
+                        help='also record the peak memory of every phase (in a second, untimed run of every scenario)')
+    parser.add_argument('--neighbor-search', default='kdtree')
+    parser.add_argument('--import-budget', type=float,
+                        help='only check that importing the simulation core takes at most this many seconds, '
+                             'without loading any of the HEAVY_MODULES')
+    args = parser.parse_args(argv)
+
+    if args.import_budget is not None:
+        seconds, loaded = measure_import()
+        print(f'import sir_simulation_classes: {seconds * 1e3:.1f} ms (budget {args.import_budget * 1e3:.1f} ms)')
+        if loaded:
+            print(f'the import loaded {", ".join(loaded)}')
+        return int(seconds > args.import_budget or bool(loaded))
+
+    results = run_benchmarks(args.sizes, n_steps=args.steps, track_memory=args.memory,
+                             neighbor_search=args.neighbor_search)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        try:
+            regressions = compare(results, baseline, args.threshold)
+        except ValueError as e:
+            print(e)
+            return 2
+        for name, ratio in regressions.items():
+            print(f'regression: {name} is {ratio:.2f}x slower than the baseline')
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
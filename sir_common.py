@@ -0,0 +1,42 @@
+"""
+Definitions shared by the SIR simulation and its subsystems (e.g. sir_testing), kept in a module of their own so the
+subsystems don't have to import the simulation.
+"""
+import numpy as np
+
+# status codes used by the population arrays
+STATUS_CODES = {'S': 0, 'I': 1, 'R': 2}
+S, I, R = STATUS_CODES['S'], STATUS_CODES['I'], STATUS_CODES['R']
+
+
+def sample_without_replacement(rng, n, counts, exclude=None, is_excluded=None):
+    """
+    Sample distinct random indices in every group of n consecutive flat indices (a group is a replicate),
+    in O(samples) instead of O(n): duplicates and excluded indices are redrawn until there are none
+    :param rng: np.random.Generator
+    :param n: the size of every group
+    :param counts: the number of samples in every group
+    :param exclude: optional array of flat indices that can't be sampled
+    :param is_excluded: optional function from an array of flat indices to a boolean array, True for the indices
+                        that can't be sampled (the caller must make sure enough indices can be sampled)
+    :return: array of flat indices, sorted by group
+    """
+    counts = np.asarray(counts)
+    available = n - (0 if exclude is None else np.bincount(exclude // n, minlength=len(counts)))
+    if np.any(counts > available):
+        raise ValueError(f'cannot take {counts.max()} samples out of a population of {n}')
+    groups = np.repeat(np.arange(len(counts)), counts)
+    sample = groups * n + rng.integers(0, n, size=len(groups))
+    while True:
+        order = np.argsort(sample, kind='stable')
+        sorted_sample = sample[order]
+        is_invalid = np.zeros(len(sample), dtype=bool)
+        is_invalid[order[1:]] = sorted_sample[1:] == sorted_sample[:-1]
+        if exclude is not None:
+            is_invalid |= np.isin(sample, exclude)
+        if is_excluded is not None:
+            is_invalid |= is_excluded(sample)
+        if not is_invalid.any():
+            return sample
+        redraw = np.flatnonzero(is_invalid)
+        sample[redraw] = groups[redraw] * n + rng.integers(0, n, size=len(redraw))
@@ -0,0 +1,127 @@
+"""
+Real-time plotting of the SIR simulation
+"""
+import numpy as np
+from matplotlib import pyplot as plt
+from matplotlib.colors import to_rgba
+from matplotlib.lines import Line2D
+
+from sir_simulation_classes import STATUS_CODES
+
+
+class PopulationRenderer(object):
+    """
+    Draws the population locations frame after frame.
+    All the artists are created once, and every frame only updates their data (offsets, sizes, colors).
+    When the canvas supports it, frames are drawn by blitting: the static background (axes, ticks, legend) is saved
+    once, and only the animated artists are redrawn on top of it.
+    """
+    def __init__(self, status_colors, map_size, blit=True, fig=None, ax=None):
+        """
+        :param status_colors: status -> color
+        :param map_size: the axes limits are [0, map_size]
+        :param blit: use blitting if the canvas supports it. Should be False when the figure is shown by other
+                     means than the canvas itself (e.g. IPython.display)
+        """
+        if fig is None:
+            fig, ax = plt.subplots()
+        self.fig = fig
+        self.ax = ax
+        self.blit = blit and getattr(fig.canvas, 'supports_blit', False)
+        ax.set_xlim([0, map_size])
+        ax.set_ylim([0, map_size])
+        ax.set_aspect('equal')
+
+        # a table from status code to color, so the colors of all the people are a single lookup
+        self.status_rgba = np.zeros((len(STATUS_CODES), 4))
+        for status, c in status_colors.items():
+            self.status_rgba[STATUS_CODES[status]] = to_rgba(c)
+
+        empty = np.zeros((0, 2))
+        self.people = ax.scatter(empty[:, 0], empty[:, 1], s=[], animated=self.blit)
+        self.isolated, = ax.plot([], [], 'kx', animated=self.blit)
+        self.symptomatic = ax.scatter(empty[:, 0], empty[:, 1], s=80, facecolors='none', edgecolors='y',
+                                      animated=self.blit)
+        self.title = ax.set_title('', animated=self.blit)
+        self.artists = [self.people, self.isolated, self.symptomatic, self.title]
+
+        # the legend is static, so it uses proxy artists instead of the animated ones
+        handles = [Line2D([], [], marker='o', linestyle='', color=c, label=status)
+                   for status, c in status_colors.items()]
+        handles.append(Line2D([], [], marker='x', linestyle='', color='k', label='isolated'))
+        handles.append(Line2D([], [], marker='o', linestyle='', markerfacecolor='none', markeredgecolor='y',
+                              markersize=9, label='symptomatic'))
+        ax.legend(handles=handles, loc=4)
+
+        self.background = None
+        if self.blit:
+            # the background has to be saved again whenever the whole figure is redrawn (e.g. after resizing)
+            fig.canvas.mpl_connect('draw_event', self._on_draw)
+            plt.show(block=False)
+            fig.canvas.draw()
+
+    def _on_draw(self, event):
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_artists()
+
+    def _draw_artists(self):
+        for artist in self.artists:
+            self.fig.draw_artist(artist)
+
+    def update(self, pop, t, title_postfix=''):
+        """
+        Draw a single frame
+        :param pop: the Population to draw
+        :param t: the time, in days
+        :param title_postfix: added to the title
+        :return:
+        """
+        positions = np.column_stack((pop.pos_x, pop.pos_y))
+        self.people.set_offsets(positions)
+        self.people.set_sizes(pop.get('days_in_status'))
+        self.people.set_facecolors(self.status_rgba[pop.status])
+        self.people.set_edgecolors('face')
+        is_isolated = pop.get('is_isolated')
+        self.isolated.set_data(pop.pos_x[is_isolated], pop.pos_y[is_isolated])
+        self.symptomatic.set_offsets(positions[pop.get('symptoms_score') > 0])
+        self.title.set_text(f't = {t:.2f} [days]' + title_postfix)
+
+        canvas = self.fig.canvas
+        if self.blit and self.background is not None:
+            canvas.restore_region(self.background)
+            self._draw_artists()
+            canvas.blit(self.fig.bbox)
+            canvas.flush_events()
+        else:
+            canvas.draw_idle()
+
+    def pause(self, interval):
+        """
+        Let the GUI event loop run. Unlike plt.pause, this doesn't redraw the whole figure
+        :param interval: seconds
+        :return:
+        """
+        # a non-positive timeout would run the event loop until it's stopped
+        if interval > 0:
+            self.fig.canvas.start_event_loop(interval)
+
+
+def plot_pop_locations(pop_df, status_colors, t, fig=None, ax=None,
+                       xlim=None, ylim=None, title_postfix=''):
+    if fig is None:
+        fig, ax = plt.subplots()
+    ax.cla()
+    if xlim is not None:
+        ax.set_xlim(xlim)
+        ax.set_ylim(ylim)
+    for status, c in status_colors.items():
+        ax.scatter(pop_df[pop_df.status == status].pos_x,
+                   pop_df[pop_df.status == status].pos_y, c=c,
+                   s=pop_df[pop_df.status == status].days_in_status, label=status)
+    ax.plot(pop_df[pop_df.is_isolated].pos_x,
+            pop_df[pop_df.is_isolated].pos_y, 'kx', label='isolated')
+    ax.scatter(pop_df[pop_df.symptoms_score > 0].pos_x,
+               pop_df[pop_df.symptoms_score > 0].pos_y, s=80, facecolors='none', edgecolors='y', label='symptomatic')
+    ax.legend(loc=4)
+    ax.set_title(f't = {t:.2f} [days]' + title_postfix)
+    return fig, ax
@@ -0,0 +1,276 @@
+"""
+Neighbor search engines for finding infectious contacts in the SIR simulation.
+Every engine answers the same question: given the positions of the infective and the susceptible people,
+which susceptible people are closer than the infection radius to some infective person, and which infective
+people are closer than the infection radius to some susceptible person.
+"""
+import numpy as np
+
+NEIGHBOR_SEARCH_METHODS = ('brute', 'kdtree', 'grid')
+
+# the tiled kernel works on the population in chunks of this many people
+_CHUNK_SIZE = 2 ** 16
+# and makes the tiles large enough to hold at least this many people on average
+_MIN_TILE_OCCUPANCY = 16
+
+
+def find_contacts(i_pos, s_pos, radius, map_size=None, method='kdtree', i_groups=None, s_groups=None):
+    """
+    Find the infectious contacts between two sets of positions
+    :param i_pos: (n_i, 2) array with the positions of the infective people
+    :param s_pos: (n_s, 2) array with the positions of the susceptible people
+    :param radius: a pair is a contact if the distance is strictly smaller than the radius
+    :param map_size: if not None, the map is a torus with this side length and distances are periodic
+    :param method: one of NEIGHBOR_SEARCH_METHODS. 'brute' is the full distance matrix (O(n_i * n_s)),
+                   'kdtree' and 'grid' run in near-linear time and give the same result
+    :param i_groups: optional non-negative integer group of every infective person (e.g. the replicate index
+                     of an ensemble). If given, only pairs in the same group are contacts
+    :param s_groups: the groups of the susceptible people (required if i_groups is given)
+    :return: (is_infected, is_infecting) - boolean arrays of lengths n_s and n_i
+    """
+    i_pos = np.asarray(i_pos, dtype=float).reshape(-1, 2)
+    s_pos = np.asarray(s_pos, dtype=float).reshape(-1, 2)
+    if len(i_pos) == 0 or len(s_pos) == 0:
+        return np.zeros(len(s_pos), dtype=bool), np.zeros(len(i_pos), dtype=bool)
+    if i_groups is not None:
+        i_groups = np.asarray(i_groups, dtype=np.int64)
+        s_groups = np.asarray(s_groups, dtype=np.int64)
+    if method == 'brute':
+        return _brute_contacts(i_pos, s_pos, radius, map_size, i_groups, s_groups)
+    if method == 'kdtree':
+        return _kdtree_contacts(i_pos, s_pos, radius, map_size, i_groups, s_groups)
+    if method == 'grid':
+        return _grid_contacts(i_pos, s_pos, radius, map_size, i_groups, s_groups)
+    raise ValueError(f'unknown neighbor search method: {method!r} (expected one of {NEIGHBOR_SEARCH_METHODS})')
+
+
+def wrap_positions(pos, map_size):
+    """
+    Wrap positions into [0, map_size). np.mod alone can return exactly map_size for tiny negative values
+    """
+    pos = np.mod(pos, map_size)
+    pos[pos >= map_size] = 0
+    return pos
+
+
+def _brute_contacts(i_pos, s_pos, radius, map_size, i_groups, s_groups):
+    if map_size is None:
+        from scipy.spatial import distance_matrix
+
+        dist_arr = distance_matrix(i_pos, s_pos)
+    else:
+        diff = np.abs(i_pos[:, np.newaxis, :] - s_pos[np.newaxis, :, :])
+        diff = np.minimum(diff, map_size - diff)
+        dist_arr = np.sqrt((diff ** 2).sum(axis=2))
+    is_contact = dist_arr < radius
+    if i_groups is not None:
+        is_contact &= i_groups[:, np.newaxis] == s_groups[np.newaxis, :]
+    return np.any(is_contact, axis=0), np.any(is_contact, axis=1)
+
+
+def _kdtree_contacts(i_pos, s_pos, radius, map_size, i_groups, s_groups):
+    # scipy is imported only when used, so the 'grid' engine works without it and the import stays cheap
+    from scipy.spatial import cKDTree
+    boxsize = map_size
+    if map_size is not None:
+        i_pos = wrap_positions(i_pos, map_size)
+        s_pos = wrap_positions(s_pos, map_size)
+    if i_groups is not None:
+        # groups become a third coordinate, spaced so that people from different groups are never in contact
+        spacing = 2. * radius
+        i_pos = np.column_stack((i_pos, i_groups * spacing))
+        s_pos = np.column_stack((s_pos, s_groups * spacing))
+        if map_size is not None:
+            n_groups = max(i_groups.max(), s_groups.max()) + 1
+            boxsize = [map_size, map_size, n_groups * spacing]
+    # a nearest neighbor query bounded by the radius is much cheaper than collecting all the neighbors in the ball
+    i_tree = cKDTree(i_pos, boxsize=boxsize)
+    s_tree = cKDTree(s_pos, boxsize=boxsize)
+    is_infected = i_tree.query(s_pos, k=1, distance_upper_bound=radius)[0] < radius
+    is_infecting = s_tree.query(i_pos, k=1, distance_upper_bound=radius)[0] < radius
+    return is_infected, is_infecting
+
+
+def _grid_contacts(i_pos, s_pos, radius, map_size, i_groups, s_groups):
+    """
+    Uniform grid (cell list) with cells at least as large as the radius, so every contact of a person is in one
+    of the 9 cells around it. Candidate pairs are generated one neighbor cell offset at a time.
+    Groups are handled by giving every group its own copy of the grid.
+    """
+    if map_size is not None:
+        i_pos = wrap_positions(i_pos, map_size)
+        s_pos = wrap_positions(s_pos, map_size)
+        n_cells = np.array([max(int(map_size // radius), 1)] * 2)
+        origin = np.zeros(2)
+        cell_size = map_size / n_cells
+    else:
+        origin = np.minimum(i_pos.min(axis=0), s_pos.min(axis=0))
+        extent = np.maximum(i_pos.max(axis=0), s_pos.max(axis=0)) - origin
+        cell_size = np.array([radius, radius], dtype=float)
+        n_cells = (extent // radius).astype(int) + 1
+    i_cell = np.minimum(((i_pos - origin) // cell_size).astype(np.int64), n_cells - 1)
+    s_cell = np.minimum(((s_pos - origin) // cell_size).astype(np.int64), n_cells - 1)
+
+    # sort the susceptible by cell, so each cell is a contiguous range of `s_order`
+    s_key = s_cell[:, 0] * n_cells[1] + s_cell[:, 1]
+    if s_groups is not None:
+        s_key += s_groups * (n_cells[0] * n_cells[1])
+    s_order = np.argsort(s_key, kind='stable')
+    s_key_sorted = s_key[s_order]
+
+    is_infected = np.zeros(len(s_pos), dtype=bool)
+    is_infecting = np.zeros(len(i_pos), dtype=bool)
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            cell = i_cell + [dx, dy]
+            if map_size is not None:
+                cell = np.mod(cell, n_cells)
+                valid = np.ones(len(cell), dtype=bool)
+            else:
+                valid = np.all((cell >= 0) & (cell < n_cells), axis=1)
+            key = cell[:, 0] * n_cells[1] + cell[:, 1]
+            if i_groups is not None:
+                key += i_groups * (n_cells[0] * n_cells[1])
+            start = np.searchsorted(s_key_sorted, key, side='left')
+            counts = np.where(valid, np.searchsorted(s_key_sorted, key, side='right') - start, 0)
+            n_pairs = counts.sum()
+            if n_pairs == 0:
+                continue
+            # expand every infective person to the range of susceptible people in the neighbor cell
+            pair_i = np.repeat(np.arange(len(i_pos)), counts)
+            pair_offset = np.arange(n_pairs) - np.repeat(np.cumsum(counts) - counts, counts)
+            pair_s = s_order[np.repeat(start, counts) + pair_offset]
+            diff = np.abs(i_pos[pair_i] - s_pos[pair_s])
+            if map_size is not None:
+                diff = np.minimum(diff, map_size - diff)
+            is_contact = np.sqrt((diff ** 2).sum(axis=1)) < radius
+            is_infected[pair_s[is_contact]] = True
+            is_infecting[pair_i[is_contact]] = True
+    return is_infected, is_infecting
+
+
+def _bucket_by_key(mask, key_of, n_keys):
+    """
+    Counting sort of the flat indices where `mask` is True by an integer key, one chunk of the population at a time,
+    so the only population-sized temporary is the result (one int32 per selected person).
+    :param mask: flat boolean array selecting the people to sort
+    :param key_of: function from an array of flat indices to their keys (in range(n_keys))
+    :param n_keys: the number of keys
+    :return: (order, starts) - the selected flat indices sorted by key (stable), and the (n_keys + 1) offsets of the
+             keys in `order`, so the people with key k are order[starts[k]:starts[k + 1]]
+    """
+    index_dtype = np.int32 if len(mask) <= np.iinfo(np.int32).max else np.int64
+    starts = np.zeros(n_keys + 1, dtype=np.int64)
+    for chunk_start in range(0, len(mask), _CHUNK_SIZE):
+        idx = np.flatnonzero(mask[chunk_start:chunk_start + _CHUNK_SIZE]) + chunk_start
+        starts[1:] += np.bincount(key_of(idx), minlength=n_keys)
+    np.cumsum(starts, out=starts)
+    order = np.empty(starts[-1], dtype=index_dtype)
+    fill = starts[:-1].copy()
+    for chunk_start in range(0, len(mask), _CHUNK_SIZE):
+        idx = (np.flatnonzero(mask[chunk_start:chunk_start + _CHUNK_SIZE]) + chunk_start).astype(index_dtype)
+        keys = key_of(idx)
+        chunk_order = np.argsort(keys, kind='stable')
+        keys = keys[chunk_order]
+        # the rank of every person among the people of the chunk with the same key
+        rank = np.arange(len(keys)) - np.searchsorted(keys, keys, side='left')
+        order[fill[keys] + rank] = idx[chunk_order]
+        chunk_keys, chunk_counts = np.unique(keys, return_counts=True)
+        fill[chunk_keys] += chunk_counts
+    return order, starts
+
+
+def find_contacts_tiled(pos_x, pos_y, is_i, is_s, radius, map_size, tile_size, periodic=False, method='kdtree',
+                        group_size=None, executor=None):
+    """
+    The same as find_contacts, but the map is partitioned into square tiles which are processed one at a time:
+    for each tile, the infective people in the tile are matched against the susceptible people in the tile and in
+    a halo of width `radius` around it. The people are bucketed by tile with a chunked counting sort, which keeps one
+    int32 index per infective or susceptible person; all the other temporary arrays (positions, search structures,
+    candidate pairs) are gathered for one tile (and its halo) at a time, so they are bounded by the tile occupancy.
+    The tiles are independent, so they can be processed in parallel; the results are merged in tile order, so they
+    don't depend on the number of workers.
+    :param pos_x: the x positions of the whole population (flat array)
+    :param pos_y: the y positions of the whole population (flat array)
+    :param is_i: flat boolean array, True for the infective people
+    :param is_s: flat boolean array, True for the susceptible people
+    :param radius: a pair is a contact if the distance is strictly smaller than the radius
+    :param map_size: the side length of the map
+    :param tile_size: the requested side length of a tile (rounded so the tiles cover the map exactly, at least the
+                      radius, and large enough to hold a few people on average)
+    :param periodic: if True, the map is a torus and distances are periodic
+    :param method: the neighbor search method used inside every tile (see find_contacts)
+    :param group_size: if not None, the population is made of consecutive groups of this size (e.g. the replicates
+                       of an ensemble) and only pairs in the same group are contacts
+    :param executor: an optional concurrent.futures executor (e.g. a ThreadPoolExecutor) for processing the tiles
+    :return: (infected, infecting) - sorted flat indices of the susceptible people with an infective contact, and of
+             the infective people with a susceptible contact
+    """
+    empty = np.zeros(0, dtype=np.int32)
+    if not is_i.any() or not is_s.any():
+        return empty, empty
+    n_groups = 1 if group_size is None else -(-len(pos_x) // group_size)
+    # tiles holding only a few people add overhead without saving memory, and the tile tables grow with their number
+    max_tiles = max(int(np.sqrt(len(pos_x) / (n_groups * _MIN_TILE_OCCUPANCY))), 1)
+    n_tiles = min(max(int(map_size // max(tile_size, radius)), 1), max_tiles)
+    tile_size = map_size / n_tiles
+
+    def tile_of(pos):
+        if periodic:
+            pos = np.mod(pos, map_size)
+        # on a bounded map, people outside the map belong to the edge tiles
+        return np.clip((pos // tile_size).astype(np.int64), 0, n_tiles - 1)
+
+    def tile_key(idx):
+        key = tile_of(pos_x[idx]) * n_tiles + tile_of(pos_y[idx])
+        if group_size is not None:
+            key += (idx // group_size) * n_tiles ** 2
+        return key
+
+    # both sets sorted by tile, so each tile is a contiguous range
+    i_order, i_starts = _bucket_by_key(is_i, tile_key, n_groups * n_tiles ** 2)
+    s_order, s_starts = _bucket_by_key(is_s, tile_key, n_groups * n_tiles ** 2)
+
+    def tile_contacts(key):
+        group, tile = divmod(key, n_tiles ** 2)
+        tile_x, tile_y = divmod(tile, n_tiles)
+        # the susceptible people in the 3x3 block of tiles around the tile (a tile is at least as large as the radius)
+        neighbor_x = np.arange(tile_x - 1, tile_x + 2)
+        neighbor_y = np.arange(tile_y - 1, tile_y + 2)
+        if periodic:
+            neighbor_x, neighbor_y = np.mod(neighbor_x, n_tiles), np.mod(neighbor_y, n_tiles)
+        else:
+            neighbor_x = neighbor_x[(neighbor_x >= 0) & (neighbor_x < n_tiles)]
+            neighbor_y = neighbor_y[(neighbor_y >= 0) & (neighbor_y < n_tiles)]
+        neighbor_keys = np.unique(group * n_tiles ** 2 + neighbor_x[:, np.newaxis] * n_tiles + neighbor_y)
+        s_local = np.concatenate([s_order[s_starts[k]:s_starts[k + 1]] for k in neighbor_keys])
+        if len(s_local) == 0:
+            return None
+        # keep only the halo: the susceptible people closer than the radius to the tile
+        s_pos = np.column_stack((pos_x[s_local], pos_y[s_local])).astype(float)
+        tile_xy = np.array([tile_x, tile_y])
+        if periodic:
+            offset = s_pos - (tile_xy + 0.5) * tile_size
+            offset -= map_size * np.round(offset / map_size)
+            in_halo = np.all(np.abs(offset) < tile_size / 2 + radius, axis=1)
+        else:
+            # the edge tiles are unbounded on the outer side
+            low = np.where(tile_xy > 0, tile_xy * tile_size - radius, -np.inf)
+            high = np.where(tile_xy < n_tiles - 1, (tile_xy + 1) * tile_size + radius, np.inf)
+            in_halo = np.all((s_pos > low) & (s_pos < high), axis=1)
+        s_local, s_pos = s_local[in_halo], s_pos[in_halo]
+        i_local = i_order[i_starts[key]:i_starts[key + 1]]
+        i_pos = np.column_stack((pos_x[i_local], pos_y[i_local]))
+        tile_infected, tile_infecting = find_contacts(i_pos, s_pos, radius, map_size=map_size if periodic else None,
+                                                      method=method)
+        return s_local[tile_infected], i_local[tile_infecting]
+
+    tiles = np.flatnonzero(np.diff(i_starts)).tolist()
+    results = map(tile_contacts, tiles) if executor is None else executor.map(tile_contacts, tiles)
+    infected, infecting = [empty], [empty]
+    for result in results:
+        if result is not None:
+            infected.append(result[0])
+            infecting.append(result[1])
+    # a susceptible person in the halo of several tiles can be found more than once
+    return np.unique(np.concatenate(infected)), np.sort(np.concatenate(infecting))
@@ -0,0 +1,89 @@
+"""
+Per-phase timing of the SIR iterations (test_and_isolate, update_locations, infect, remove, update_symptoms).
+Enabled with params['profile'] = True (or by setting sir.profiler = PhaseProfiler()); when it's off, the phases are
+called directly and nothing is recorded.
+"""
+import time
+import tracemalloc
+
+import numpy as np
+
+
+class PhaseProfiler(object):
+    """
+    Records the wall time of every phase of every iteration, with the number of infective people at the start of
+    the phase (so the cost of the phases can be related to the size of the epidemic).
+    With track_memory, the peak of the memory allocated during every phase is recorded too (using tracemalloc,
+    which slows the simulation down, so it's off by default)
+    """
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.its = []
+        self.phases = []
+        self.seconds = []
+        self.n_infective = []
+        self.peak_bytes = []
+
+    def run(self, it, name, phase, n_infective):
+        """
+        Run a phase of the simulation and record its time
+        :param it: the iteration
+        :param name: the name of the phase
+        :param phase: callable without arguments
+        :param n_infective: the number of infective people at the start of the phase
+        :return:
+        """
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        phase()
+        self.seconds.append(time.perf_counter() - start)
+        if self.track_memory:
+            self.peak_bytes.append(tracemalloc.get_traced_memory()[1] - start_bytes)
+        self.its.append(it)
+        self.phases.append(name)
+        self.n_infective.append(n_infective)
+
+    def to_df(self):
+        """
+        :return: DataFrame with a row per recorded phase (it, phase, seconds, n_infective and peak_bytes if the
+                 memory is tracked)
+        """
+        import pandas as pd
+        df = pd.DataFrame({'it': self.its, 'phase': self.phases, 'seconds': self.seconds,
+                           'n_infective': self.n_infective})
+        if self.track_memory:
+            df['peak_bytes'] = self.peak_bytes
+        return df
+
+    def summary(self):
+        """
+        :return: dict from a phase name to its number of calls, mean and 95th percentile time (in seconds),
+                 share of the total time, and maximal peak_bytes if the memory is tracked
+        """
+        phases = np.array(self.phases)
+        seconds = np.array(self.seconds)
+        total = seconds.sum()
+        summary = {}
+        for name in dict.fromkeys(self.phases):
+            phase_seconds = seconds[phases == name]
+            summary[name] = {'calls': len(phase_seconds),
+                             'mean': phase_seconds.mean(),
+                             'p95': np.percentile(phase_seconds, 95),
+                             'share': phase_seconds.sum() / total if total > 0 else 0.}
+            if self.track_memory:
+                summary[name]['peak_bytes'] = int(np.array(self.peak_bytes)[phases == name].max())
+        return summary
+
+    def report(self):
+        """
+        :return: the summary as a printable table (times in milliseconds)
+        """
+        lines = [f'{"phase":<20}{"calls":>8}{"mean [ms]":>12}{"p95 [ms]":>12}{"share":>8}']
+        for name, stats in self.summary().items():
+            lines.append(f'{name:<20}{stats["calls"]:>8}{stats["mean"] * 1e3:>12.3f}{stats["p95"] * 1e3:>12.3f}'
+                         f'{stats["share"]:>8.1%}')
+        return '\n'.join(lines)
@@ -1,43 +1,468 @@
+import copy
+import os
+import pickle
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-import pandas as pd
-from matplotlib import pyplot as plt
-from scipy.spatial import distance_matrix
-from tqdm import tqdm
 import time
 
+from sir_common import I, R, S, STATUS_CODES, sample_without_replacement
+from sir_neighbors import find_contacts, find_contacts_tiled
+from sir_profiling import PhaseProfiler
+from sir_testing import DiagnosticTesting
+
+
+class Population(object):
+    """
+    Struct-of-arrays store of the population: every attribute is a contiguous NumPy column,
+    and the i-th element of every column belongs to the i-th person.
+    An ensemble of replicates is stored with a leading replicate axis, i.e. columns of shape (n_replicates, n).
+    The simulation reads and writes the columns through get and set, so subclasses can store them differently
+    """
+    # the columns seen by the simulation
+    columns = ('status', 'pos_x', 'pos_y', 'direction', 'days_in_status', 'infections_count',
+               'is_symptomatic', 'symptoms_score', 'is_isolated')
+    # the arrays that are actually stored, and their types
+    storage = {
+        'status': np.int8,  # codes from STATUS_CODES
+        'pos_x': np.float32,
+        'pos_y': np.float32,
+        'direction': np.float32,
+        'days_in_status': np.float32,  # how many days have passed since entering the current status
+        'infections_count': np.int32,  # how many people were infected by the person
+        'is_symptomatic': bool,  # True - will show symptoms (at some point), False - will never show symptoms
+        'symptoms_score': np.int8,  # represent the severity of the symptoms (0 - no symptoms, 1 - maximum symptoms)
+        'is_isolated': bool,
+    }
+
+    def __init__(self, n, n_replicates=None):
+        shape = n if n_replicates is None else (n_replicates, n)
+        for column, dtype in self.storage.items():
+            setattr(self, column, np.zeros(shape, dtype=dtype))
+
+    def __len__(self):
+        """
+        :return: the number of people (in each replicate)
+        """
+        return self.status.shape[-1]
+
+    @property
+    def shape(self):
+        return self.status.shape
+
+    @classmethod
+    def bytes_per_agent(cls):
+        return sum(np.dtype(dtype).itemsize for dtype in cls.storage.values())
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, column).nbytes for column in self.storage)
+
+    def get(self, column, idx=Ellipsis):
+        """
+        :param column: a name from self.columns
+        :param idx: index (e.g. index tuple or boolean mask). By default, the whole column
+        :return: the values of the column
+        """
+        return getattr(self, column)[idx]
+
+    def set(self, column, idx, value):
+        """
+        :param column: a name from self.columns
+        :param idx: index (e.g. index tuple or boolean mask)
+        :param value: the new values
+        :return:
+        """
+        getattr(self, column)[idx] = value
+
+    def advance_days(self, days):
+        """
+        Add to the days_in_status of everyone
+        :param days: the length of an iteration, in days
+        :return:
+        """
+        self.days_in_status += days
+
+    def replicate(self, r):
+        """
+        A view of a single replicate of an ensemble population (the arrays are shared, not copied)
+        :param r: replicate index
+        :return: Population
+        """
+        pop = copy.copy(self)
+        for column in self.storage:
+            setattr(pop, column, getattr(self, column)[r])
+        return pop
+
+    def to_df(self, statuses):
+        """
+        Build a pandas DataFrame with a row per person
+        :param statuses: the categories of the 'status' column
+        :return: DataFrame
+        """
+        import pandas as pd
+        status_names = np.empty(len(STATUS_CODES), dtype=object)
+        for status, code in STATUS_CODES.items():
+            status_names[code] = status
+        pop_df = pd.DataFrame({'status': pd.Categorical(status_names[self.status], categories=list(statuses))})
+        for column in self.columns[1:]:
+            pop_df[column] = self.get(column)
+        return pop_df
+
+
+class CompactPopulation(Population):
+    """
+    A Population with a smaller memory footprint (15 instead of 24 bytes per person), for very large simulations:
+    the direction is quantized to 16 bits, days_in_status is kept as a saturating 16 bit count of iterations,
+    infections_count saturates at 255, and the three flags (is_symptomatic, is_isolated and a binary
+    symptoms_score) are packed into the bits of a single byte
+    """
+    storage = {
+        'status': np.int8,
+        'pos_x': np.float32,
+        'pos_y': np.float32,
+        'direction': np.uint16,  # in units of 2 * pi / 2 ** 16
+        'iters_in_status': np.uint16,
+        'infections_count': np.uint8,
+        'flags': np.uint8,
+    }
+    flag_bits = {'is_symptomatic': 1, 'is_isolated': 2, 'symptoms_score': 4}
+    direction_unit = 2 * np.pi / 2 ** 16
+
+    def __init__(self, n, n_replicates=None, iter_per_day=1):
+        Population.__init__(self, n, n_replicates)
+        self.iter_per_day = iter_per_day
+
+    def get(self, column, idx=Ellipsis):
+        if column in self.flag_bits:
+            is_set = (self.flags[idx] & self.flag_bits[column]) > 0
+            return is_set.astype(np.int8) if column == 'symptoms_score' else is_set
+        if column == 'days_in_status':
+            return self.iters_in_status[idx] / np.float32(self.iter_per_day)
+        if column == 'direction':
+            return self.direction[idx] * np.float32(self.direction_unit)
+        if column == 'infections_count':
+            # widened, so incrementing a saturated count doesn't wrap around before set clamps it
+            return self.infections_count[idx].astype(np.int32)
+        return getattr(self, column)[idx]
+
+    def set(self, column, idx, value):
+        if column in self.flag_bits:
+            bit = self.flag_bits[column]
+            flags = self.flags[idx]
+            self.flags[idx] = np.where(np.asarray(value) > 0, flags | bit, flags & ~np.uint8(bit))
+        elif column == 'days_in_status':
+            iters = np.round(np.asarray(value) * self.iter_per_day)
+            self.iters_in_status[idx] = np.minimum(iters, np.iinfo(np.uint16).max)
+        elif column == 'direction':
+            self.direction[idx] = np.round(np.mod(value, 2 * np.pi) / self.direction_unit).astype(np.int64) % 2 ** 16
+        elif column == 'infections_count':
+            self.infections_count[idx] = np.minimum(value, np.iinfo(np.uint8).max)
+        else:
+            getattr(self, column)[idx] = value
+
+    def advance_days(self, days):
+        iters = round(days * self.iter_per_day)
+        max_iters = np.iinfo(np.uint16).max
+        np.add(self.iters_in_status, iters, out=self.iters_in_status, where=self.iters_in_status <= max_iters - iters)
+
+
+# every subsystem draws from its own random stream, so changing how one subsystem uses randomness doesn't change
+# the random numbers seen by the others
+RNG_STREAMS = ('init', 'movement', 'infection', 'removal', 'testing', 'symptoms')
+
+
+def make_rng_streams(random_state):
+    """
+    Create independent random generators for the subsystems of a simulation
+    :param random_state: an int seed, or a np.random.SeedSequence (e.g. from spawn_random_states)
+    :return: dict from a name in RNG_STREAMS to a np.random.Generator
+    """
+    if isinstance(random_state, np.random.SeedSequence):
+        seed_seq = random_state
+    else:
+        seed_seq = np.random.SeedSequence(random_state)
+    children = seed_seq.spawn(len(RNG_STREAMS))
+    return {name: np.random.Generator(np.random.PCG64(child)) for name, child in zip(RNG_STREAMS, children)}
+
+
+def spawn_random_states(random_state, n):
+    """
+    Spawn independent seeds for replicates of the same simulation, e.g. for a sweep:
+    param_grid(params, random_state=spawn_random_states(42, 100))
+    :param random_state: int seed, or a np.random.SeedSequence
+    :param n: the number of replicates
+    :return: list of np.random.SeedSequence, to be used as params['random_state']
+    """
+    if isinstance(random_state, np.random.SeedSequence):
+        # the children are derived without spawning from random_state itself, which would change its later spawns
+        return [np.random.SeedSequence(random_state.entropy, spawn_key=random_state.spawn_key + (k,),
+                                       pool_size=random_state.pool_size) for k in range(n)]
+    return np.random.SeedSequence(random_state).spawn(n)
+
+
+def _generator_from_state(state):
+    generator = np.random.Generator(np.random.PCG64())
+    generator.bit_generator.state = state
+    return generator
+
 
 # noinspection PyPep8Naming
 class SIR(object):
     def __init__(self, params):
         self.params = params
-        np.random.seed(params['random_state'])
-        self.pop_df = self.initiate_pop_df()
+        self.rng = self.make_rng(params['random_state'])
+        self.pop = self.initiate_pop()
+        self._pop_df = None
         self.t = np.arange(0, self.params['n_days'], 1. / self.params['iter_per_day'])
+        self.it = 0  # the index of the current iteration in self.t
+        self.outputs = []  # the outputs gathered by run_sim
+        self.init_counters()
+        self.event_times = self.params.get('event_times', False)
+        if self.event_times:
+            self.init_events()
+        self.testing = DiagnosticTesting(self.params)
+        self.profiler = PhaseProfiler() if self.params.get('profile', False) else None
+        # movement and infection are local, so they are split between worker threads by region. Everything that
+        # draws random numbers runs on the main thread, so the results don't depend on the number of workers
+        self.n_workers = self.params.get('n_workers', 1)
+        self.executor = ThreadPoolExecutor(self.n_workers) if self.n_workers > 1 else None
 
-    def initiate_pop_df(self):
+    def make_rng(self, random_state):
         """
-        Initiating the population DataFrame.
-        This DataFrame should contain all the needed information about each person
-        :return:
+        Create the random generators of the simulation
+        :param random_state: an int seed, or a np.random.SeedSequence
+        :return: dict from a name in RNG_STREAMS to a np.random.Generator
+        """
+        return make_rng_streams(random_state)
+
+    def draw(self, stream, sample):
+        """
+        Draw random values from the stream of a subsystem, replicate by replicate. In an ensemble every replicate has
+        its own generator of the stream, so the values of a replicate don't depend on the other replicates
+        :param stream: a name from RNG_STREAMS
+        :param sample: function (generator, replicate index) -> array of the values of the replicate
+        :return: the values of all the replicates, concatenated in replicate order
+        """
+        generators = self.rng[stream]
+        if not isinstance(generators, list):
+            generators = [generators]
+        return np.concatenate([sample(generator, r) for r, generator in enumerate(generators)])
+
+    def initiate_pop(self, n_replicates=None):
+        """
+        Initiating the population arrays.
+        These arrays should contain all the needed information about each person
+        :param n_replicates: if not None, create this number of independent replicates of the population
+        :return: Population
         """
-        status_list = []
+        n = sum(self.params['init_status'].values())
+        compact = self.params.get('compact', False)
+        population_class = CompactPopulation if compact else Population
+        memory_budget = self.params.get('memory_budget')
+        if memory_budget is not None:
+            n_bytes = population_class.bytes_per_agent() * n * (n_replicates or 1)
+            if n_bytes > memory_budget:
+                raise MemoryError(f'the population needs {n_bytes:,} bytes '
+                                  f'({population_class.bytes_per_agent()} bytes per agent), '
+                                  f'which is more than the memory budget of {memory_budget:,} bytes'
+                                  + ('' if compact else " (consider params['compact'] = True)"))
+        if compact:
+            pop = CompactPopulation(n, n_replicates, self.params['iter_per_day'])
+        else:
+            pop = Population(n, n_replicates)
+        start = 0
         for status, n_status in self.params['init_status'].items():
-            status_list.extend([status] * n_status)
+            pop.status[..., start:start + n_status] = STATUS_CODES[status]
+            start += n_status
+
+        def sample(rng, r):
+            return rng.random(n, dtype=np.float32)
 
-        pop_df = pd.DataFrame({'status': status_list})
-        pop_df['pos_x'] = np.random.random(len(pop_df)) * self.params['map_size']
-        pop_df['pos_y'] = np.random.random(len(pop_df)) * self.params['map_size']
+        pop.pos_x[:] = self.draw('init', sample).reshape(pop.shape) * self.params['map_size']
+        pop.pos_y[:] = self.draw('init', sample).reshape(pop.shape) * self.params['map_size']
         if self.params['I_init_pos'] is not None:
-            pop_df.loc[pop_df.status == 'I', ['pos_x', 'pos_y']] = self.params['I_init_pos']
-        pop_df['direction'] = np.random.random(len(pop_df)) * 2 * np.pi
-        pop_df['status'] = pop_df['status']. \
-            astype('category').cat.set_categories(self.params['init_status'].keys())
-        pop_df['days_in_status'] = 0  # how many days have passed since entering the current status
-        pop_df['infections_count'] = 0  # how many people were infected by the person
-        pop_df['is_symptomatic'] = False  # True - will show symptoms (at some point), False - will never show symptoms
-        pop_df['symptoms_score'] = 0  # represent the severity of the symptoms (0 - no symptoms, 1 - maximum symptoms)
-        pop_df['is_isolated'] = False
-        return pop_df
+            pop.pos_x[pop.status == I], pop.pos_y[pop.status == I] = self.params['I_init_pos']
+        pop.set('direction', Ellipsis, self.draw('init', sample).reshape(pop.shape) * 2 * np.pi)
+        return pop
+
+    def memory_report(self):
+        """
+        :return: dict with the memory used by the population arrays
+        """
+        n_agents = self.pop.status.size
+        return {'n_agents': n_agents,
+                'bytes': self.pop.nbytes,
+                'bytes_per_agent': self.pop.nbytes / n_agents}
+
+    def save_checkpoint(self, path):
+        """
+        Save the whole state of the simulation (population, random generators, iteration, outputs, etc.) into a
+        directory: a .npy file per population array, and a pickle with everything else.
+        The checkpoint is written to a sibling directory that then replaces path, so an existing checkpoint in path
+        is never overwritten in place (it may be memory mapped by this very simulation) and a failed save leaves it
+        intact
+        :param path: directory
+        :return:
+        """
+        path = os.path.normpath(path)
+        tmp_path, old_path = path + '.tmp', path + '.old'
+        for p in (tmp_path, old_path):
+            if os.path.exists(p):
+                shutil.rmtree(p)
+        os.makedirs(tmp_path)
+        for column in self.pop.storage:
+            np.save(os.path.join(tmp_path, column + '.npy'), getattr(self.pop, column))
+        state = {key: value for key, value in self.__dict__.items() if key not in ('pop', 'rng', 'executor', '_pop_df')}
+        # a list of states in an ensemble (a generator per replicate)
+        state['rng'] = {name: [g.bit_generator.state for g in rng] if isinstance(rng, list) else rng.bit_generator.state
+                        for name, rng in self.rng.items()}
+        state['pop_class'] = type(self.pop)
+        state['pop'] = {key: value for key, value in self.pop.__dict__.items() if key not in self.pop.storage}
+        with open(os.path.join(tmp_path, 'state.pkl'), 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(path):
+            # the memory maps of the old files stay valid after they are removed
+            os.replace(path, old_path)
+            os.replace(tmp_path, path)
+            shutil.rmtree(old_path)
+        else:
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load_checkpoint(cls, path, mmap=True):
+        """
+        Restore a simulation saved by save_checkpoint. It continues exactly as the saved one would have (run_sim
+        resumes from the saved iteration)
+        :param path: directory
+        :param mmap: if True, the population arrays are copy-on-write memory maps of the checkpoint files, so loading
+                     is immediate and the checkpoint itself is never modified
+        :return: the restored simulation
+        """
+        with open(os.path.join(path, 'state.pkl'), 'rb') as f:
+            state = pickle.load(f)
+        pop_class = state.pop('pop_class')
+        pop = pop_class.__new__(pop_class)
+        pop.__dict__.update(state.pop('pop'))
+        for column in pop.storage:
+            setattr(pop, column, np.load(os.path.join(path, column + '.npy'), mmap_mode='c' if mmap else None))
+        rng = {}
+        for name, rng_state in state.pop('rng').items():
+            if isinstance(rng_state, list):
+                rng[name] = [_generator_from_state(replicate_state) for replicate_state in rng_state]
+            else:
+                rng[name] = _generator_from_state(rng_state)
+        sir = cls.__new__(cls)
+        sir.__dict__.update(state)
+        sir.pop = pop
+        sir.rng = rng
+        sir._pop_df = None
+        sir.executor = ThreadPoolExecutor(sir.n_workers) if sir.n_workers > 1 else None
+        return sir
+
+    def fork(self, random_state=None):
+        """
+        Clone the simulation, so several branches (e.g. with different params) can continue from the same state.
+        The clone's params can be changed without affecting the original
+        :param random_state: if given, the clone gets new random generators (otherwise both continue with the same
+                             random numbers)
+        :return: the clone
+        """
+        executor, self.executor = self.executor, None
+        try:
+            clone = copy.deepcopy(self)
+        finally:
+            self.executor = executor
+        if random_state is not None:
+            clone.rng = clone.make_rng(random_state)
+        clone.executor = ThreadPoolExecutor(clone.n_workers) if clone.n_workers > 1 else None
+        return clone
+
+    @property
+    def pop_df(self):
+        """
+        A pandas view of the population, built lazily from the population arrays (read only - changes made
+        to it are not applied to the simulation)
+        :return: DataFrame
+        """
+        if self._pop_df is None:
+            self._pop_df = self.pop.to_df(self.params['init_status'].keys())
+        return self._pop_df
+
+    def init_events(self):
+        """
+        Initiate the event-time mode: instead of drawing a random number for every person in every iteration,
+        the iterations of removal and symptom onset are sampled once per person when the person gets infected
+        (from the geometric distributions that are equivalent to the per-iteration draws), and kept in schedules
+        that map an iteration to the flat indices of the people whose event is due in it
+        :return:
+        """
+        self.removal_schedule = {}
+        self.symptoms_schedule = {}
+        self.non_infective_symptoms_idx = tuple(np.zeros(0, dtype=np.int64) for _ in self.pop.shape)
+        self.schedule_events(np.nonzero(self.pop.status == I), first_it=1)
+
+    def schedule_events(self, idx, first_it):
+        """
+        Sample the removal and symptom onset iterations of newly infective people, and add them to the schedules
+        :param idx: index tuple of the newly infective people (sorted by replicate)
+        :param first_it: the first iteration in which they can be removed or show symptoms
+        :return:
+        """
+        flat_idx = np.ravel_multi_index(idx, self.pop.shape)
+        counts = np.reshape(self._count_per_replicate(idx), -1)
+        remove_prob = min(1., 1 / (self.params['infection_duration'] * self.params['iter_per_day']))
+        symptoms_prob = min(1., 1 / self.params['days_to_symptoms'])
+        removal_it = first_it - 1 + self.draw('removal', lambda rng, r: rng.geometric(remove_prob, size=counts[r]))
+        onset_it = first_it - 1 + self.draw('symptoms', lambda rng, r: rng.geometric(symptoms_prob, size=counts[r]))
+        # in every iteration the removal comes before the symptoms update, so a person removed in the same
+        # iteration will never show symptoms
+        has_onset = self.pop.get('is_symptomatic', idx) & (onset_it < removal_it)
+        _add_to_schedule(self.removal_schedule, flat_idx, removal_it)
+        _add_to_schedule(self.symptoms_schedule, flat_idx[has_onset], onset_it[has_onset])
+
+    def init_counters(self):
+        """
+        Initiate the counters that are updated incrementally by the transitions in infect, remove and
+        test_and_isolate, so the outputs of every iteration don't need a pass over the whole population
+        :return:
+        """
+        self.status_counts, self.new_infections_count, self.i_not_isolated_count = self.recount()
+
+    def recount(self):
+        """
+        Count from scratch what the counters count incrementally
+        :return: (status_counts, new_infections_count, i_not_isolated_count). status_counts is ordered
+                 by STATUS_CODES (with a leading replicate axis in an ensemble)
+        """
+        pop = self.pop
+        is_infective = pop.status == I
+        status_counts = np.stack([(pop.status == code).sum(axis=-1) for code in STATUS_CODES.values()], axis=-1)
+        new_infections_count = (is_infective & (pop.get('days_in_status') == 0)).sum(axis=-1)
+        i_not_isolated_count = (is_infective & ~pop.get('is_isolated')).sum(axis=-1)
+        return status_counts, new_infections_count, i_not_isolated_count
+
+    def check_counters(self):
+        """
+        Cross-check the incremental counters against a full recount (used in debug mode)
+        :return:
+        """
+        for name, counter, recounted in zip(['status_counts', 'new_infections_count', 'i_not_isolated_count'],
+                                            [self.status_counts, self.new_infections_count,
+                                             self.i_not_isolated_count],
+                                            self.recount()):
+            if not np.array_equal(counter, recounted):
+                raise RuntimeError(f'counter {name} is {counter}, but a full recount gives {recounted}')
+
+    def _count_per_replicate(self, idx):
+        """
+        :param idx: index tuple into the population arrays
+        :return: the number of indexed people (per replicate, in an ensemble)
+        """
+        if self.pop.status.ndim > 1:
+            return np.bincount(idx[0], minlength=self.pop.shape[0])
+        return len(idx[0])
 
     def calc_R(self):
         """
@@ -46,179 +471,440 @@ class SIR(object):
         and multiply by the infection duration.
         :return: R
         """
-        new_infections = (self.pop_df.status == 'I') & \
-                         (self.pop_df.days_in_status == 0)
-        infecting = (self.pop_df.status == 'I') & \
-                    (self.pop_df.days_in_status > 0) & ~self.pop_df.is_isolated
-        if infecting.sum() == 0:
-            return np.nan
-        R = self.params['infection_duration'] * self.params['iter_per_day'] * \
-            (new_infections.sum() / infecting.sum())
-        return R
+        new_infections = self.new_infections_count
+        # new infections are never isolated, so the rest of the non-isolated infective are the infecting ones
+        infecting = self.i_not_isolated_count - new_infections
+        with np.errstate(divide='ignore', invalid='ignore'):
+            R = self.params['infection_duration'] * self.params['iter_per_day'] * \
+                (new_infections / infecting)
+        return np.where(infecting == 0, np.nan, R)[()]
 
     def run_sim(self, real_time_plot=False,
-                frame_delay=0.001, status_colors=None, display=None):
+                frame_delay=0.001, status_colors=None, display=None, frame_skip=1):
         """
         main method that run the simulation, gathers the outputs and optionally plots
+        :param frame_skip: when plotting, draw only every frame_skip iterations, so drawing doesn't throttle
+                           the simulation
         :return: list of outputs (an element per each iteration
         """
         if status_colors is None:
             status_colors = {'S': 'b', 'I': 'r', 'R': 'g'}
-        outputs = [self.get_outputs(t=self.t[0])]
         if real_time_plot:
-            fig, ax = plt.subplots()
-            plt.axis('equal')
+            from sir_display import PopulationRenderer
+            # blitting draws on the GUI canvas, so it can't be used when the figure is shown by `display`
+            renderer = PopulationRenderer(status_colors, self.params['map_size'], blit=display is None)
         else:
-            fig = ax = None
+            renderer = None
 
-        for t in tqdm(self.t[1:]):
-            self.sir_iter()
-            outputs.append(self.get_outputs(t=t))
-            if real_time_plot:
-                plt.cla()
-                fig, ax = self.plot_pop_locations(self.pop_df, status_colors, t,
-                                                  fig=fig, ax=ax, xlim=[0, self.params['map_size']],
-                                                  ylim=[0, self.params['map_size']],
-                                                  title_postfix=f'\nR = {self.calc_R():.2f}')
+        outputs = self.iter_sim()
+        if len(self.outputs) > self.it:
+            # resuming (e.g. from a checkpoint), the outputs of the current iteration were already gathered
+            next(outputs)
+        for output in outputs:
+            self.outputs.append(output)
+            if real_time_plot and self.it > 0 and self.it % frame_skip == 0:
+                renderer.update(self.pop, output['t'], title_postfix=f'\nR = {output["rep_num"]:.2f}')
                 if display is not None:
                     display.clear_output(wait=True)
-                    display.display(fig)
+                    display.display(renderer.fig)
                     time.sleep(frame_delay)
                 else:
-                    plt.pause(frame_delay)
+                    renderer.pause(frame_delay)
+
+        return self.outputs
 
-        return outputs
+    def iter_sim(self, progress=True):
+        """
+        Run the simulation, yielding the outputs of every iteration as soon as they are computed, e.g. for writing
+        them to an OutputSink (see sir_storage) instead of keeping them all in memory
+        :param progress: show a progress bar
+        :return: generator of outputs dicts (see get_outputs), starting with the current iteration
+        """
+        yield self.get_outputs(t=self.t[self.it])
+        for t in _progress_bar(self.t[self.it + 1:], progress):
+            self.sir_iter()
+            yield self.get_outputs(t=t)
+        if self.profiler is not None:
+            print(self.profiler.report())
 
     def sir_iter(self, apply_isolation=True):
         """
         Run a single iteration
         :return:
         """
+        self._pop_df = None
+        self.it += 1
         if apply_isolation:
-            self.test_and_isolate()
-        self.update_locations()
+            self.run_phase('test_and_isolate', self.test_and_isolate)
+        self.run_phase('update_locations', self.update_locations)
         self.update_status()
-        self.update_symptoms()
+        self.run_phase('update_symptoms', self.update_symptoms)
+        if self.params.get('debug_counters', False):
+            self.check_counters()
 
     @staticmethod
     def plot_pop_locations(pop_df, status_colors, t, fig=None, ax=None,
                            xlim=None, ylim=None, title_postfix=''):
-        if fig is None:
-            fig, ax = plt.subplots()
-        ax.cla()
-        if xlim is not None:
-            ax.set_xlim(xlim)
-            ax.set_ylim(ylim)
-        for status, c in status_colors.items():
-            ax.scatter(pop_df[pop_df.status == status].pos_x,
-                       pop_df[pop_df.status == status].pos_y, c=c,
-                       s=pop_df[pop_df.status == status].days_in_status, label=status)
-        ax.plot(pop_df[pop_df.is_isolated].pos_x,
-                pop_df[pop_df.is_isolated].pos_y, 'kx', label='isolated')
-        ax.scatter(pop_df[pop_df.symptoms_score > 0].pos_x,
-                   pop_df[pop_df.symptoms_score > 0].pos_y, s=80, facecolors='none', edgecolors='y', label='symptomatic')
-        ax.legend(loc=4)
-        ax.set_title(f't = {t:.2f} [days]' + title_postfix)
-        return fig, ax
+        # plotting is imported only when used, so headless runs don't load matplotlib
+        from sir_display import plot_pop_locations
+        return plot_pop_locations(pop_df, status_colors, t, fig=fig, ax=ax, xlim=xlim, ylim=ylim,
+                                  title_postfix=title_postfix)
 
     def update_status(self):
         """
-        Update the "status" and "days_in_status" columns of the DataFrame
+        Update the "status" and "days_in_status" columns of the population
+        :return:
+        """
+        self.pop.advance_days(1 / self.params['iter_per_day'])
+        self.new_infections_count = np.zeros_like(self.new_infections_count)
+        self.run_phase('infect', self.infect)
+        self.run_phase('remove', self.remove)
+
+    def run_phase(self, name, phase):
+        """
+        Run a phase of the iteration, timing it if the profiler is on (see sir_profiling)
+        :param name: the name of the phase
+        :param phase: callable without arguments
         :return:
         """
-        self.pop_df['days_in_status'] = \
-            self.pop_df['days_in_status'] + 1 / self.params['iter_per_day']
-        self.infect()
-        self.remove()
+        if self.profiler is None:
+            phase()
+        else:
+            self.profiler.run(self.it, name, phase, int(self.status_counts[..., I].sum()))
 
     def infect(self):
         """
         Move people from 'S' to 'I' status
         :return:
         """
-        # todo: find more efficient way to find nearest neighbor distance (consider using scipy.spatial.KDTree)
-        i_and_not_isolated = (self.pop_df.status == 'I') & (~self.pop_df.is_isolated)
-        s_and_not_isolated = (self.pop_df.status == 'S') & (~self.pop_df.is_isolated)
-        i_pos = self.pop_df.loc[i_and_not_isolated, ['pos_x', 'pos_y']].values
-        s_pos = self.pop_df.loc[s_and_not_isolated, ['pos_x', 'pos_y']].values
-        dist_arr = distance_matrix(i_pos, s_pos)
-        is_infected = np.any(dist_arr < self.params['infection_radius'], axis=0)
-        is_infecting = np.any(dist_arr < self.params['infection_radius'], axis=1)
-        infected_idx = s_and_not_isolated[s_and_not_isolated].index[is_infected]
-        infecting_idx = i_and_not_isolated[i_and_not_isolated].index[is_infecting]
-        self.pop_df.loc[infected_idx, 'status'] = 'I'
-        self.pop_df.loc[infected_idx, 'days_in_status'] = 0
-        self.pop_df.loc[infected_idx, 'is_symptomatic'] = \
-            np.random.random(len(infected_idx)) > self.params['symptoms_prob']
-        self.pop_df.loc[infecting_idx, 'infections_count'] = self.pop_df.loc[infecting_idx, 'infections_count'] + 1
+        pop = self.pop
+        is_isolated = pop.get('is_isolated')
+        # flat masks (over all the replicates in an ensemble)
+        is_i = ((pop.status == I) & ~is_isolated).reshape(-1)
+        is_s = ((pop.status == S) & ~is_isolated).reshape(-1)
+        pos_x, pos_y = pop.pos_x.reshape(-1), pop.pos_y.reshape(-1)
+        periodic = self.params.get('periodic_boundaries', False)
+        method = self.params.get('neighbor_search', 'kdtree')
+        tile_size = self.params.get('infection_tile_size')
+        if tile_size is None and self.executor is not None:
+            tile_size = self.params['map_size'] / self.n_workers
+        if tile_size is None:
+            i_and_not_isolated, s_and_not_isolated = np.flatnonzero(is_i), np.flatnonzero(is_s)
+            if pop.status.ndim > 1:
+                # people are in contact only with people of the same replicate
+                i_groups, s_groups = i_and_not_isolated // len(pop), s_and_not_isolated // len(pop)
+            else:
+                i_groups = s_groups = None
+            i_pos = np.column_stack((pos_x[i_and_not_isolated], pos_y[i_and_not_isolated]))
+            s_pos = np.column_stack((pos_x[s_and_not_isolated], pos_y[s_and_not_isolated]))
+            # 'brute' is the full distance matrix, 'kdtree' and 'grid' give the same result in near-linear time
+            is_infected, is_infecting = find_contacts(i_pos, s_pos, self.params['infection_radius'],
+                                                      map_size=self.params['map_size'] if periodic else None,
+                                                      method=method, i_groups=i_groups, s_groups=s_groups)
+            infected, infecting = s_and_not_isolated[is_infected], i_and_not_isolated[is_infecting]
+        else:
+            # tile by tile, so the temporary arrays are bounded by the tile occupancy (see find_contacts_tiled)
+            infected, infecting = find_contacts_tiled(pos_x, pos_y, is_i, is_s, self.params['infection_radius'],
+                                                      self.params['map_size'], tile_size, periodic=periodic,
+                                                      method=method,
+                                                      group_size=len(pop) if pop.status.ndim > 1 else None,
+                                                      executor=self.executor)
+        infected_idx = np.unravel_index(infected, pop.shape)
+        infecting_idx = np.unravel_index(infecting, pop.shape)
+        pop.status[infected_idx] = I
+        pop.set('days_in_status', infected_idx, 0)
+        n_infected = self._count_per_replicate(infected_idx)
+        counts = np.reshape(n_infected, -1)
+        pop.set('is_symptomatic', infected_idx,
+                self.draw('infection', lambda rng, r: rng.random(counts[r])) > self.params['symptoms_prob'])
+        pop.set('infections_count', infecting_idx, pop.get('infections_count', infecting_idx) + 1)
+        self.status_counts[..., S] -= n_infected
+        self.status_counts[..., I] += n_infected
+        self.new_infections_count += n_infected
+        self.i_not_isolated_count += n_infected
+        if self.event_times:
+            self.schedule_events(infected_idx, first_it=self.it)
 
     def remove(self):
         """
         Move people from 'I' to 'R' status
         :return:
         """
-        # is_remove = (self.pop_df.status == 'I') & \
-        #             (self.pop_df.days_in_status > self.params['infection_duration'])
-        is_remove = (self.pop_df.status == 'I') & \
-                    (np.random.random(len(self.pop_df)) < 1 / (self.params['infection_duration'] *
-                                                               self.params['iter_per_day']))
+        pop = self.pop
+        if self.event_times:
+            # the removal iterations were sampled at infection time, only the people that are due are touched
+            removed_idx = np.unravel_index(_pop_due(self.removal_schedule, self.it), pop.shape)
+        else:
+            # is_remove = (pop.status == I) & \
+            #             (pop.days_in_status > self.params['infection_duration'])
+            draw = self.draw('removal', lambda rng, r: rng.random(len(pop))).reshape(pop.shape)
+            is_remove = (pop.status == I) & \
+                        (draw < 1 / (self.params['infection_duration'] * self.params['iter_per_day']))
+            removed_idx = np.nonzero(is_remove)
+        n_removed = self._count_per_replicate(removed_idx)
+        self.status_counts[..., I] -= n_removed
+        self.status_counts[..., R] += n_removed
+        self.new_infections_count -= self._count_per_replicate(
+            _select(removed_idx, pop.get('days_in_status', removed_idx) == 0))
+        self.i_not_isolated_count -= self._count_per_replicate(
+            _select(removed_idx, ~pop.get('is_isolated', removed_idx)))
 
-        self.pop_df.loc[is_remove, 'status'] = 'R'
-        self.pop_df.loc[is_remove, 'days_in_status'] = 0
-        self.pop_df.loc[is_remove, 'symptoms_score'] = 0  # when someone is removed he stops showing symptoms
+        pop.status[removed_idx] = R
+        pop.set('days_in_status', removed_idx, 0)
+        pop.set('symptoms_score', removed_idx, 0)  # when someone is removed he stops showing symptoms
 
     def test_and_isolate(self):
         """
-        Sample the population for testing and isolate according to some rule.
+        Test people and isolate the ones whose positive results arrived (see sir_testing).
         This should be a central part of the research
         :return:
         """
-        # Sample random people and isolate the infected (assume the test accuracy is perfect)
-        # todo: add FN and FP
-        tested_df = self.pop_df.sample(round(self.params['tests_per_day'] / self.params['iter_per_day']))
-        # notice the rounding might change the tests_per_day (negligible in large numbers)
-        tested_positive_idx = tested_df[tested_df.status == 'I'].index
-        self.pop_df.loc[tested_positive_idx, 'is_isolated'] = True
+        pop = self.pop
+        positive_idx = np.unravel_index(self.testing.test(self), pop.shape)
+        positive_idx = _select(positive_idx, ~pop.get('is_isolated', positive_idx))
+        pop.set('is_isolated', positive_idx, True)
+        self.i_not_isolated_count -= self._count_per_replicate(_select(positive_idx, pop.status[positive_idx] == I))
 
     def update_locations(self):
-        # step_direction = np.random.random(len(self.pop_df)) * 2 * np.pi
-        step_direction = self.pop_df.direction
-        self.pop_df['pos_x'] = self.pop_df['pos_x'] + np.sin(step_direction) * self.params['step_size_iter']
-        self.pop_df['pos_y'] = self.pop_df['pos_y'] + np.cos(step_direction) * self.params['step_size_iter']
-        self.pop_df['pos_x'] = np.mod(self.pop_df['pos_x'], self.params['map_size'])
-        self.pop_df['pos_y'] = np.mod(self.pop_df['pos_y'], self.params['map_size'])
+        # every worker moves a contiguous range of people
+        bounds = np.linspace(0, len(self.pop), self.n_workers + 1).astype(int)
+        chunks = [(Ellipsis, slice(start, stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+        if self.executor is None:
+            self.move(chunks[0])
+        else:
+            list(self.executor.map(self.move, chunks))
+
+    def move(self, idx):
+        """
+        Move a range of people one step in their direction
+        :param idx: index of the people to move
+        :return:
+        """
+        pop = self.pop
+        # step_direction = self.rng['movement'].random(len(pop)) * 2 * np.pi
+        step_direction = pop.get('direction', idx)
+        pos_x, pos_y = pop.pos_x[idx], pop.pos_y[idx]
+        pos_x += np.sin(step_direction) * self.params['step_size_iter']
+        pos_y += np.cos(step_direction) * self.params['step_size_iter']
+        np.mod(pos_x, self.params['map_size'], out=pos_x)
+        np.mod(pos_y, self.params['map_size'], out=pos_y)
         # todo: add boundaries to the map and avoid stepping outside of them
 
+    def close(self):
+        """
+        Stop the worker threads (if any)
+        :return:
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+            self.n_workers = 1
+
     def update_symptoms(self):
         """
         Update the symptoms score
         :return:
         """
-        # Find agents that should show symptoms but haven't shown yet
-        i_with_no_symp_yet = \
-            (self.pop_df.status == 'I') & self.pop_df.is_symptomatic & (self.pop_df.symptoms_score == 0)
+        pop = self.pop
         default_symptoms_score = 1  # currently we use 'symptoms_score' as binary, so the score is only 1 or 0
+        if self.event_times:
+            # the onset iterations were sampled at infection time (only for people that are still infective then)
+            onset_idx = np.unravel_index(_pop_due(self.symptoms_schedule, self.it), pop.shape)
+            pop.set('symptoms_score', onset_idx, default_symptoms_score)
+            self.update_non_infective_symptoms_sparse(default_symptoms_score)
+            return
+
+        # Find agents that should show symptoms but haven't shown yet
+        i_with_no_symp_yet = (pop.status == I) & pop.get('is_symptomatic') & (pop.get('symptoms_score') == 0)
         # Poison distribution
-        self.pop_df.loc[i_with_no_symp_yet, 'symptoms_score'] = \
-            default_symptoms_score * (np.random.random(sum(i_with_no_symp_yet)) < 1 / self.params['days_to_symptoms'])
+        counts = i_with_no_symp_yet.reshape(-1, len(pop)).sum(axis=1)
+        pop.set('symptoms_score', i_with_no_symp_yet, default_symptoms_score *
+                (self.draw('symptoms', lambda rng, r: rng.random(counts[r])) < 1 / self.params['days_to_symptoms']))
 
         # Randomly add symptoms to non infective (this has no memory, not very realistic, but good enough)
-        non_infective = self.pop_df.status != 'I'
-        self.pop_df.loc[non_infective, 'symptoms_score'] = \
-            default_symptoms_score * (np.random.random(sum(non_infective)) < self.params['non_infective_symptoms_prob'])
+        non_infective = pop.status != I
+        counts = non_infective.reshape(-1, len(pop)).sum(axis=1)
+        pop.set('symptoms_score', non_infective, default_symptoms_score *
+                (self.draw('symptoms', lambda rng, r: rng.random(counts[r])) <
+                 self.params['non_infective_symptoms_prob']))
+
+    def update_non_infective_symptoms_sparse(self, symptoms_score):
+        """
+        The event-time version of the random symptoms of the non infective: instead of a draw per non infective
+        person, draw how many people show symptoms (binomial) and sample only them
+        :return:
+        """
+        pop = self.pop
+        # the symptoms of the previous iteration are cleared (people that got infected keep them, like in the
+        # dense update)
+        previous_idx = self.non_infective_symptoms_idx
+        pop.set('symptoms_score', _select(previous_idx, pop.status[previous_idx] != I), 0)
+
+        prob = self.params['non_infective_symptoms_prob']
+        if prob == 0:
+            idx = tuple(np.zeros(0, dtype=np.int64) for _ in pop.shape)
+        else:
+            n_non_infective = np.reshape(self.status_counts[..., S] + self.status_counts[..., R], -1)
+            flat_idx = self.draw('symptoms', lambda rng, r: r * len(pop) + self._sample_non_infective(
+                rng, pop.status.reshape(-1, len(pop))[r], n_non_infective[r], prob))
+            idx = np.unravel_index(flat_idx, pop.shape)
+        pop.set('symptoms_score', idx, symptoms_score)
+        self.non_infective_symptoms_idx = idx
+
+    @staticmethod
+    def _sample_non_infective(rng, status, n_non_infective, prob):
+        """
+        Sample the non infective people of a replicate that show symptoms: draw how many (binomial), and sample them
+        by rejection sampling. This is O(samples) when most people are non infective
+        :param status: the statuses of the replicate
+        :return: indices into the replicate
+        """
+        if n_non_infective < len(status) / 4:
+            # rejection sampling is inefficient when most people are infective, so draw for everyone
+            return np.flatnonzero((status != I) & (rng.random(len(status)) < prob))
+        return sample_without_replacement(rng, len(status), [rng.binomial(n_non_infective, prob)],
+                                          is_excluded=lambda idx: status[idx] == I)
 
     def get_outputs(self, **kwargs):
         """
-        Extract a dictionary of outputs from the DataFrame
+        Extract a dictionary of outputs from the counters
         :return: dict
         """
-        output = self.pop_df.status.value_counts().to_dict()
+        counts = self.count_statuses()
+        output = dict(zip(self.params['init_status'], counts.tolist()))
         output.update({'rep_num': self.calc_R()})
         output.update(kwargs)
         return output
 
+    def count_statuses(self):
+        """
+        Count the people in each status, in the order of params['init_status']
+        :return: array of counts (of shape (n_replicates, n_statuses) in an ensemble)
+        """
+        codes = [STATUS_CODES[status] for status in self.params['init_status']]
+        return self.status_counts[..., codes]
+
+
+def _progress_bar(iterable, progress):
+    """
+    Wrap the iterable with a tqdm progress bar (tqdm is imported only when there is a progress bar)
+    """
+    if not progress:
+        return iterable
+    from tqdm import tqdm
+    return tqdm(iterable)
+
+
+def _select(idx, mask):
+    """
+    :param idx: index tuple
+    :param mask: boolean array over the indexed elements
+    :return: index tuple of the elements where mask is True
+    """
+    return tuple(ix[mask] for ix in idx)
+
+
+def _add_to_schedule(schedule, flat_idx, its):
+    """
+    Add people to a schedule (a dict from an iteration to a list of arrays of the people due in it)
+    :param flat_idx: flat indices of the people
+    :param its: the iteration of every person
+    :return:
+    """
+    order = np.argsort(its, kind='stable')
+    its, flat_idx = its[order], flat_idx[order]
+    unique_its, starts = np.unique(its, return_index=True)
+    for it, chunk in zip(unique_its.tolist(), np.split(flat_idx, starts[1:])):
+        schedule.setdefault(it, []).append(chunk)
+
+
+def _pop_due(schedule, it):
+    """
+    Remove the people that are due in the given iteration from a schedule
+    :return: their flat indices
+    """
+    chunks = schedule.pop(it, [])
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int64)
+
+
+class SIREnsemble(SIR):
+    """
+    Many replicates of the same SIR simulation (same params, different randomness), stored as a leading
+    replicate axis of the population arrays. Each call to sir_iter advances all the replicates together, so the
+    per-step Python overhead is paid once for the whole ensemble instead of once per replicate.
+    Every replicate has its own random streams, spawned from params['random_state'] like spawn_random_states, so
+    replicate r doesn't depend on the number of replicates and is bit-identical to a single SIR run with
+    params['random_state'] = spawn_random_states(params['random_state'], n_replicates)[r].
+    """
+    def __init__(self, params, n_replicates):
+        self.n_replicates = n_replicates
+        SIR.__init__(self, params)
+        # the number of people in each compartment in every iteration that was run so far (instead of a list of
+        # output dicts), kept with the rest of the state so a restored or forked ensemble resumes its run
+        self.outputs = np.zeros((n_replicates, len(self.t), len(self.compartments)), dtype=np.int64)
+        self.outputs[:, 0] = self.count_statuses()
+
+    def make_rng(self, random_state):
+        """
+        :return: dict from a name in RNG_STREAMS to a list with a np.random.Generator per replicate
+        """
+        streams = [make_rng_streams(seed) for seed in spawn_random_states(random_state, self.n_replicates)]
+        return {name: [replicate_streams[name] for replicate_streams in streams] for name in RNG_STREAMS}
+
+    def initiate_pop(self, n_replicates=None):
+        return SIR.initiate_pop(self, self.n_replicates)
+
+    @property
+    def pop_df(self):
+        """
+        A pandas view of all the replicates, indexed by (replicate, person) (read only)
+        :return: DataFrame
+        """
+        if self._pop_df is None:
+            import pandas as pd
+            self._pop_df = pd.concat([self.pop.replicate(r).to_df(self.params['init_status'].keys())
+                                      for r in range(self.n_replicates)],
+                                     keys=range(self.n_replicates), names=['replicate', None])
+        return self._pop_df
+
+    @property
+    def compartments(self):
+        """
+        :return: the names of the compartments in the last axis of the run_sim output
+        """
+        return list(self.params['init_status'])
+
+    def sir_iter(self, apply_isolation=True):
+        SIR.sir_iter(self, apply_isolation)
+        self.outputs[:, self.it] = self.count_statuses()
+
+    def get_outputs(self, **kwargs):
+        """
+        The outputs of the current iteration, as in SIR.get_outputs, but every status count and rep_num is an array
+        with a value per replicate
+        :return: dict
+        """
+        counts = self.count_statuses()
+        output = {status: counts[:, k] for k, status in enumerate(self.compartments)}
+        output.update({'rep_num': self.calc_R()})
+        output.update(kwargs)
+        return output
+
+    def run_sim(self, progress=True):
+        """
+        Run all the replicates (from the current iteration) and gather the number of people in each compartment
+        :return: array of shape (n_replicates, len(self.t), len(self.compartments))
+        """
+        for _ in _progress_bar(range(self.it + 1, len(self.t)), progress):
+            self.sir_iter()
+        if self.profiler is not None:
+            print(self.profiler.report())
+        return self.outputs
+
 
 def main():
+    import pandas as pd
+    from matplotlib import pyplot as plt
     params = {
         'n_days': 60,
         'iter_per_day': 4,
@@ -232,7 +918,21 @@ def main():
         'symptoms_prob': 0.2,
         'days_to_symptoms': 5,
         'non_infective_symptoms_prob': 0.0,  # the probability that a non-infective will show symptoms
-        'tests_per_day': 2
+        'tests_per_day': 2,
+        'testing_strategy': 'random',  # 'random', 'symptomatic_first' or 'contacts_first'
+        'test_sensitivity': 1.,  # the probability that an infective person tests positive
+        'test_specificity': 1.,  # the probability that a non-infective person tests negative
+        'test_turnaround_days': 0,  # the time until the results arrive and the positives are isolated
+        'contact_tracing_radius': None,  # if None, the infection_radius
+        'event_times': False,  # if True, removal and symptom onset times are sampled once, at infection time
+        'compact': False,  # if True, use a smaller memory footprint per agent (for very large populations)
+        'memory_budget': None,  # if not None, the maximal number of bytes for the population arrays
+        'debug_counters': False,  # if True, the incremental counters are checked against a full recount
+        'neighbor_search': 'kdtree',  # 'brute', 'kdtree' or 'grid'
+        'periodic_boundaries': False,  # if True, infection distances wrap around the map like the locations do
+        'infection_tile_size': None,  # if not None, infections are found tile by tile (bounded temporary memory)
+        'profile': False,  # if True, the time of every phase of every iteration is recorded (see sir_profiling)
+        'n_workers': 1,  # the number of threads for movement and infection (the results don't depend on it)
     }
     sir = SIR(params)
     outputs = sir.run_sim(real_time_plot=True, frame_delay=0.000001)
@@ -0,0 +1,212 @@
+"""
+Incremental columnar storage of the SIR outputs, so long runs don't have to keep all their outputs in memory:
+    with OutputSink('run_outputs') as sink:
+        for output in sir.iter_sim():
+            sink.write(output)
+The outputs are appended in chunks, either as Parquet row groups (when pyarrow is installed) or as a directory of
+npz files (a file per chunk). read_outputs reads the chunks written so far, so an npz run can be monitored while
+it's running (a Parquet file is readable only after the sink is closed).
+
+Per-agent histories are recorded by a TrajectoryRecorder into memory-mapped arrays:
+    recorder = TrajectoryRecorder('run_trajectory', sir, every=4, agents=np.arange(0, len(sir.pop), 10))
+    for output in sir.iter_sim():
+        recorder.record(sir)
+    trajectory = open_trajectory('run_trajectory')  # e.g. trajectory['pos_x'][row, agent] at trajectory['it'][row]
+"""
+import json
+import os
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+SINK_FORMATS = ('npz', 'parquet')
+TRAJECTORY_COLUMNS = ('pos_x', 'pos_y', 'status', 'is_isolated')
+
+
+class OutputSink(object):
+    """
+    Buffers the per-iteration output dicts, and appends them to disk column by column every chunk_size iterations
+    """
+    def __init__(self, path, chunk_size=1000, fmt=None):
+        """
+        :param path: a directory for 'npz', a file for 'parquet'
+        :param chunk_size: the number of iterations in every chunk
+        :param fmt: one of SINK_FORMATS. By default, 'parquet' if pyarrow is installed, otherwise 'npz'
+        """
+        if fmt is None:
+            fmt = 'parquet' if pyarrow is not None else 'npz'
+        if fmt not in SINK_FORMATS:
+            raise ValueError(f'unknown output format: {fmt!r} (expected one of {SINK_FORMATS})')
+        if fmt == 'parquet' and pyarrow is None:
+            raise ImportError("the 'parquet' output format requires pyarrow")
+        self.path = path
+        self.chunk_size = chunk_size
+        self.fmt = fmt
+        self.fields = None
+        self.buffer = []
+        self.n_chunks = 0
+        self.n_written = 0
+        self._writer = None
+        if fmt == 'npz':
+            os.makedirs(path, exist_ok=True)
+
+    def write(self, output):
+        """
+        Add the outputs of a single iteration
+        :param output: dict (see SIR.get_outputs). All the outputs of a run must have the same keys
+        :return:
+        """
+        if self.fields is None:
+            self.fields = list(output)
+        self.buffer.append([output[field] for field in self.fields])
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered outputs as a new chunk
+        :return:
+        """
+        if not self.buffer:
+            return
+        columns = {field: np.asarray(values) for field, values in zip(self.fields, zip(*self.buffer))}
+        if self.fmt == 'npz':
+            # written to a temporary file and renamed, so readers never see a partial chunk
+            chunk_path = os.path.join(self.path, f'chunk_{self.n_chunks:06d}.npz')
+            with open(chunk_path + '.tmp', 'wb') as f:
+                np.savez(f, **columns)
+            os.replace(chunk_path + '.tmp', chunk_path)
+        else:
+            # multi-dimensional columns (e.g. the per-replicate outputs of an ensemble) are stored as lists
+            table = pyarrow.table({field: pyarrow.array(list(values)) if values.ndim > 1 else values
+                                   for field, values in columns.items()})
+            if self._writer is None:
+                self._writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+        self.n_chunks += 1
+        self.n_written += len(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_outputs(path, columns=None):
+    """
+    Read the outputs written by an OutputSink (only the chunks that were already flushed)
+    :param path: the path given to the OutputSink
+    :param columns: optional list of columns to read
+    :return: DataFrame with a row per iteration (the cells of multi-dimensional columns are arrays)
+    """
+    import pandas as pd
+    if not os.path.isdir(path):
+        if pyarrow is None:
+            raise ImportError('reading Parquet outputs requires pyarrow')
+        return pyarrow.parquet.read_table(path, columns=columns).to_pandas()
+    chunks = []
+    for name in sorted(os.listdir(path)):
+        if name.startswith('chunk_') and name.endswith('.npz'):
+            with np.load(os.path.join(path, name)) as chunk:
+                # multi-dimensional columns (e.g. the per-replicate outputs of an ensemble) are read as arrays
+                chunks.append(pd.DataFrame({field: list(chunk[field]) if chunk[field].ndim > 1 else chunk[field]
+                                            for field in (columns or chunk.files)}))
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+
+class TrajectoryRecorder(object):
+    """
+    Records population columns into preallocated memory-mapped .npy arrays of shape (n_records, n_agents)
+    (with the replicate axis in the middle for an ensemble), one file per column, in a directory.
+    The number of recorded rows is kept in meta.json, so the trajectory can be read while it's being recorded.
+    The recorded iterations are the multiples of `every` from the iteration the recorder was created in (e.g. of a
+    restored or forked simulation), and row k holds the k-th of them.
+    """
+    def __init__(self, path, sir, every=1, agents=None, columns=TRAJECTORY_COLUMNS):
+        """
+        :param path: a directory for the trajectory files
+        :param sir: the simulation to record (used for the shapes and the dtypes)
+        :param every: record every `every` iterations (temporal downsampling)
+        :param agents: indices of the people to record (agent subsampling). By default, everyone
+        :param columns: the population columns to record
+        """
+        self.path = path
+        self.every = every
+        self.agents = np.arange(len(sir.pop)) if agents is None else np.asarray(agents)
+        self.columns = list(columns)
+        # the first recorded iteration, the earlier ones were run before the recorder existed
+        self.first_it = -(-sir.it // every) * every
+        self.n_rows = len(range(self.first_it, len(sir.t), every))
+        self.n_written = 0
+        os.makedirs(path, exist_ok=True)
+        self.t = np.lib.format.open_memmap(os.path.join(path, 't.npy'), mode='w+', dtype=np.float64,
+                                           shape=(self.n_rows,))
+        np.save(os.path.join(path, 'agents.npy'), self.agents)
+        self.arrays = {}
+        for column in self.columns:
+            values = sir.pop.get(column)[..., self.agents]
+            self.arrays[column] = np.lib.format.open_memmap(os.path.join(path, column + '.npy'), mode='w+',
+                                                            dtype=values.dtype, shape=(self.n_rows,) + values.shape)
+        self._write_meta()
+
+    def record(self, sir):
+        """
+        Record the current iteration of the simulation, if it's one of the recorded iterations
+        :param sir: SIR
+        :return:
+        """
+        if sir.it % self.every != 0 or sir.it < self.first_it:
+            return
+        row = (sir.it - self.first_it) // self.every
+        self.t[row] = sir.t[sir.it]
+        for column, array in self.arrays.items():
+            array[row] = sir.pop.get(column)[..., self.agents]
+        self.n_written = max(self.n_written, row + 1)
+        self._write_meta()
+
+    def _write_meta(self):
+        meta = {'columns': self.columns, 'every': self.every, 'first_it': self.first_it, 'n_rows': self.n_rows,
+                'n_written': self.n_written}
+        # written to a temporary file and renamed, so readers never see a partial file
+        meta_path = os.path.join(self.path, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def close(self):
+        for array in [self.t] + list(self.arrays.values()):
+            array.flush()
+
+
+def open_trajectory(path):
+    """
+    Open a trajectory written by a TrajectoryRecorder (finished or still being recorded), without reading it into
+    memory: the columns are read-only memory maps, truncated to the rows that were already recorded
+    :param path: the path given to the TrajectoryRecorder
+    :return: dict with 't' and 'it' (the time and the iteration of every row), 'agents' and a
+             (n_written, ..., n_agents) array per recorded column
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    n_written = meta['n_written']
+    trajectory = {'t': np.load(os.path.join(path, 't.npy'), mmap_mode='r')[:n_written],
+                  'it': meta['first_it'] + meta['every'] * np.arange(n_written),
+                  'agents': np.load(os.path.join(path, 'agents.npy'))}
+    for column in meta['columns']:
+        trajectory[column] = np.load(os.path.join(path, column + '.npy'), mmap_mode='r')[:n_written]
+    return trajectory
@@ -0,0 +1,153 @@
+"""
+Parameter sweeps: running many SIR simulations (e.g. a grid over infection_radius, tests_per_day, step_size_iter)
+in parallel on a process pool.
+The workers write their per-iteration outputs directly into one shared-memory array, so nothing but the number of
+completed iterations is pickled back to the main process.
+"""
+import itertools
+import multiprocessing
+import signal
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from sir_simulation_classes import SIR, STATUS_CODES
+
+# the outputs saved for every iteration of every run
+SWEEP_FIELDS = ('t',) + tuple(STATUS_CODES) + ('rep_num',)
+
+# set in every worker process by _init_worker
+_cancel_event = None
+
+
+def param_grid(base_params, **axes):
+    """
+    Build a list of param dicts from the cartesian product of the given values,
+    e.g. param_grid(params, infection_radius=[50, 100], tests_per_day=[0, 10, 100])
+    :param base_params: the values of all the params that are not swept
+    :param axes: param name -> list of values
+    :return: list of param dicts
+    """
+    names = list(axes)
+    return [dict(base_params, **dict(zip(names, values))) for values in itertools.product(*axes.values())]
+
+
+class SweepResult(object):
+    """
+    The outputs of a sweep. outputs[run, it, field] holds SWEEP_FIELDS[field] at iteration it of the run,
+    and iterations that were not run (shorter runs, or cancelled runs) are NaN.
+    """
+    def __init__(self, params_list, outputs, n_iters):
+        self.params_list = params_list
+        self.outputs = outputs
+        self.n_iters = n_iters  # the number of iterations that were completed in every run
+        self.fields = SWEEP_FIELDS
+
+    @property
+    def is_complete(self):
+        return all(n == n_steps(params) for n, params in zip(self.n_iters, self.params_list))
+
+    def run_df(self, run):
+        """
+        The outputs of a single run, in the same format as pd.DataFrame(SIR(params).run_sim())
+        :param run: index of the run
+        :return: DataFrame
+        """
+        import pandas as pd
+        return pd.DataFrame(self.outputs[run, :self.n_iters[run]], columns=self.fields)
+
+
+def n_steps(params):
+    """
+    :return: the number of iterations (including the initial state) of a simulation with the given params
+    """
+    return len(np.arange(0, params['n_days'], 1. / params['iter_per_day']))
+
+
+def run_sweep(params_list, n_workers=None, progress=True, cancel_event=None):
+    """
+    Run a simulation for every param dict, in parallel on a process pool.
+    The sweep is cancelled when cancel_event is set (or on KeyboardInterrupt): runs that were not started are
+    skipped, running simulations stop at their next iteration, and the partial result is returned.
+    :param params_list: list of param dicts (see param_grid)
+    :param n_workers: number of processes (default: the number of CPUs)
+    :param progress: show a progress bar over the runs
+    :param cancel_event: an optional multiprocessing.Event used for cancelling the sweep from another thread
+    :return: SweepResult
+    """
+    params_list = list(params_list)
+    shape = (len(params_list), max(n_steps(params) for params in params_list), len(SWEEP_FIELDS))
+    if cancel_event is None:
+        cancel_event = multiprocessing.Event()
+    n_iters = [0] * len(params_list)
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(np.float64).itemsize)
+    try:
+        outputs = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        outputs[:] = np.nan
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(cancel_event,)) as executor:
+            futures = {executor.submit(_run_one, run, params, shm.name, shape): run
+                       for run, params in enumerate(params_list)}
+            try:
+                completed = as_completed(futures)
+                if progress:
+                    from tqdm import tqdm
+                    completed = tqdm(completed, total=len(futures))
+                for future in completed:
+                    n_iters[futures[future]] = future.result()
+            except KeyboardInterrupt:
+                cancel_event.set()
+                for future in futures:
+                    future.cancel()
+                for future in futures:
+                    if future.cancelled():
+                        continue
+                    run = futures[future]
+                    try:
+                        n_iters[run] = future.result()
+                    except Exception:
+                        # the worker failed (or the pool broke), keep the iterations it already wrote
+                        n_iters[run] = int(np.count_nonzero(~np.isnan(outputs[run, :, 0])))
+        result = SweepResult(params_list, outputs.copy(), n_iters)
+    finally:
+        outputs = None
+        shm.close()
+        shm.unlink()
+    return result
+
+
+def _init_worker(cancel_event):
+    global _cancel_event
+    _cancel_event = cancel_event
+    # Ctrl-C in a terminal interrupts the whole process group, only the main process should handle it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _run_one(run, params, shm_name, shape):
+    """
+    Run a single simulation in a worker process, writing its outputs into row `run` of the shared array
+    :return: the number of completed iterations
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        outputs = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)[run]
+        if _cancel_event.is_set():
+            return 0
+        sir = SIR(params)
+        _write_outputs(sir, outputs, 0)
+        for it in range(1, len(sir.t)):
+            if _cancel_event.is_set():
+                return it
+            sir.sir_iter()
+            _write_outputs(sir, outputs, it)
+        return len(sir.t)
+    finally:
+        outputs = None
+        shm.close()
+
+
+def _write_outputs(sir, outputs, it):
+    outputs[it, 0] = sir.t[it]
+    outputs[it, 1:1 + len(STATUS_CODES)] = sir.status_counts
+    outputs[it, -1] = sir.calc_R()
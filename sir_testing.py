@@ -0,0 +1,161 @@
+"""
+Testing and isolation for the SIR simulation.
+Every iteration, tests_per_day / iter_per_day people are tested in every replicate. The tested people are chosen by a
+strategy (one of TESTING_STRATEGIES), the tests have a sensitivity and a specificity, and the results arrive after
+a lab turnaround time, when the people who tested positive are isolated.
+Everything works on flat indices into the population arrays (over all the replicates of an ensemble), and the
+sampling costs O(tests) instead of O(population).
+"""
+import numpy as np
+
+from sir_common import I, sample_without_replacement
+from sir_neighbors import find_contacts
+
+TESTING_STRATEGIES = ('random', 'symptomatic_first', 'contacts_first')
+
+
+class DiagnosticTesting(object):
+    """
+    The state of the testing subsystem of a simulation: the results waiting in the lab, and the traced contacts
+    that weren't tested yet. The params are read on every call, so they can be changed during a run
+    (e.g. in a fork of the simulation). Params:
+        tests_per_day
+        testing_strategy: 'random' - test random people. 'symptomatic_first' - test people with symptoms first,
+                          and random people with the remaining tests. 'contacts_first' - test the traced contacts
+                          of people who tested positive first, and random people with the remaining tests
+        test_sensitivity: the probability that an infective person tests positive (default 1)
+        test_specificity: the probability that a non-infective person tests negative (default 1)
+        test_turnaround_days: the time until the results arrive and the positives are isolated (default 0)
+        contact_tracing_radius: the people closer than this to a positive when the result arrives are traced
+                                (default: infection_radius)
+    """
+    def __init__(self, params):
+        self.params = params
+        strategy = params.get('testing_strategy', 'random')
+        if strategy not in TESTING_STRATEGIES:
+            raise ValueError(f'unknown testing strategy: {strategy!r} (expected one of {TESTING_STRATEGIES})')
+        self.results_queue = {}  # iteration -> list of arrays of the people whose positive results arrive then
+        self.traced = np.zeros(0, dtype=np.int64)  # traced contacts that were not tested yet
+
+    def test(self, sir):
+        """
+        Run the tests of the current iteration
+        :param sir: the simulation
+        :return: flat indices of the people whose positive results arrived in this iteration
+        """
+        params = self.params
+        pop = sir.pop
+        n, n_groups = len(pop), pop.status.size // len(pop)
+        # notice the rounding might change the tests_per_day (negligible in large numbers)
+        n_tests = round(params['tests_per_day'] / params['iter_per_day'])
+
+        prioritized = self.choose_prioritized(sir, n_tests)
+        n_prioritized = np.bincount(prioritized // n, minlength=n_groups)
+        counts = n_tests - n_prioritized
+        # prioritized is grouped by replicate
+        prioritized_bounds = np.concatenate([[0], np.cumsum(n_prioritized)])
+
+        def sample(rng, r):
+            group_prioritized = prioritized[prioritized_bounds[r]:prioritized_bounds[r + 1]]
+            random_tests = sample_without_replacement(rng, n, [counts[r]], exclude=group_prioritized - r * n)
+            return np.concatenate([group_prioritized, r * n + random_tests])
+
+        tested = sir.draw('testing', sample)
+        if len(self.traced):
+            self.traced = self.traced[~np.isin(self.traced, tested)]
+
+        is_infective = pop.status.reshape(-1)[tested] == I
+        sensitivity = params.get('test_sensitivity', 1.)
+        specificity = params.get('test_specificity', 1.)
+        if sensitivity < 1 or specificity < 1:
+            tested_counts = np.bincount(tested // n, minlength=n_groups)
+            draw = sir.draw('testing', lambda rng, r: rng.random(tested_counts[r]))
+            is_positive = np.where(is_infective, draw < sensitivity, draw >= specificity)
+        else:
+            is_positive = is_infective
+
+        due_it = sir.it + int(round(params.get('test_turnaround_days', 0) * params['iter_per_day']))
+        self.results_queue.setdefault(due_it, []).append(tested[is_positive])
+        results = self.results_queue.pop(sir.it, [])
+        positive = np.unique(np.concatenate(results)) if results else np.zeros(0, dtype=np.int64)
+        if params.get('testing_strategy', 'random') == 'contacts_first':
+            self.trace_contacts(sir, positive)
+        return positive
+
+    def choose_prioritized(self, sir, n_tests):
+        """
+        Choose the people that are tested first by the strategy: up to n_tests random people (in every replicate)
+        from the priority pool. People who are isolated or waiting for a result are not in the pool
+        :return: flat indices, sorted by replicate
+        """
+        strategy = self.params.get('testing_strategy', 'random')
+        if strategy == 'random':
+            return np.zeros(0, dtype=np.int64)
+        pop = sir.pop
+        is_isolated = pop.get('is_isolated').reshape(-1)
+        if strategy == 'symptomatic_first':
+            pool = np.flatnonzero((pop.get('symptoms_score').reshape(-1) > 0) & ~is_isolated)
+        else:
+            pool = self.traced[~is_isolated[self.traced]]
+        if self.results_queue:
+            pool = pool[~np.isin(pool, np.concatenate([chunk for chunks in self.results_queue.values()
+                                                       for chunk in chunks]))]
+        # the first n_tests of a random order of the pool of every replicate (the pool is sorted)
+        bounds = np.searchsorted(pool, np.arange(pop.status.size // len(pop) + 1) * len(pop))
+
+        def sample(rng, r):
+            group_pool = pool[bounds[r]:bounds[r + 1]]
+            return group_pool[rng.permutation(len(group_pool))][:n_tests]
+
+        return sir.draw('testing', sample)
+
+    def trace_contacts(self, sir, positive):
+        """
+        Add the people who are close to the positives (and are not isolated) to the traced contacts.
+        The people are hashed into cells at least as large as the tracing radius, so only the people in the cells
+        of the positives and their 8 neighbor cells are candidates for the exact neighbor search (instead of
+        building a search structure over the whole population)
+        :param sir: the simulation
+        :param positive: flat indices of the people whose positive results arrived
+        :return:
+        """
+        if len(positive) == 0:
+            return
+        pop = sir.pop
+        params = self.params
+        n = len(pop)
+        pos_x, pos_y = pop.pos_x.reshape(-1), pop.pos_y.reshape(-1)
+        radius = params.get('contact_tracing_radius') or params['infection_radius']
+        periodic = params.get('periodic_boundaries', False)
+        map_size = params['map_size']
+        n_groups = pos_x.size // n
+        # any cell size of at least the radius works. At most about a cell per person, so a table of the cells is
+        # smaller than the population arrays
+        n_cells = max(min(int(map_size // radius), int(np.sqrt(n))), 1)
+        cells_per_unit = n_cells / map_size
+
+        def cell_key(x, y, groups, dx=0, dy=0):
+            cell_x = np.floor(x.astype(np.float64) * cells_per_unit).astype(np.int64) + dx
+            cell_y = np.floor(y.astype(np.float64) * cells_per_unit).astype(np.int64) + dy
+            if periodic:
+                cell_x, cell_y = np.mod(cell_x, n_cells), np.mod(cell_y, n_cells)
+            else:
+                # people outside the map are in the edge cells (the cells of close people still differ by at most 1)
+                cell_x, cell_y = np.clip(cell_x, 0, n_cells - 1), np.clip(cell_y, 0, n_cells - 1)
+            return (groups * n_cells + cell_x) * n_cells + cell_y
+
+        positive_groups = positive // n
+        is_near = np.zeros(n_groups * n_cells * n_cells, dtype=bool)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                is_near[cell_key(pos_x[positive], pos_y[positive], positive_groups, dx, dy)] = True
+        keys = cell_key(pop.pos_x, pop.pos_y, np.arange(n_groups).reshape(-1, 1)).reshape(-1)
+        candidates = np.flatnonzero(is_near[keys])
+        candidates = candidates[~pop.get('is_isolated').reshape(-1)[candidates] & ~np.isin(candidates, positive)]
+
+        is_contact, _ = find_contacts(np.column_stack((pos_x[positive], pos_y[positive])),
+                                      np.column_stack((pos_x[candidates], pos_y[candidates])), radius,
+                                      map_size=map_size if periodic else None,
+                                      method=params.get('neighbor_search', 'kdtree'),
+                                      i_groups=positive_groups, s_groups=candidates // n)
+        self.traced = np.union1d(self.traced, candidates[is_contact])